@@ -30,4 +30,112 @@ def geodesicDistanceSO3(R1, R2):
     return getRotationAngle(np.dot(R1, R2.T))
 
 def getRotationAngle(R):
-    return np.arccos((np.trace(R) - 1) / 2)
+    # Clipping: numerical noise can push the trace slightly outside [-1, 3].
+    return np.arccos(np.clip((np.trace(R) - 1) / 2, -1., 1.))
+
+# Batched versions of the above. All take stacks of matrices (N, 3, 3) and an
+# optional dtype; pass np.float32 to halve memory traffic on long sequences.
+
+def _asStack(R, dtype):
+    R = np.asarray(R)
+    if dtype is None:
+        dtype = np.float32 if R.dtype == np.float32 else np.float64
+    return np.asarray(R, dtype=dtype)
+
+def _angleFromTrace(trace):
+    one = trace.dtype.type(1)
+    return np.arccos(np.clip((trace - one) / 2, -one, one))
+
+def fixRotationMatrices(Rs, dtype=None):
+    Rs = _asStack(Rs, dtype)
+    u, _, vt = np.linalg.svd(Rs)
+    R_new = np.matmul(u, vt)
+    flip = np.linalg.det(R_new) < 0
+    R_new[flip] = -R_new[flip]
+    return R_new
+
+def getRotationAngles(Rs, dtype=None):
+    Rs = _asStack(Rs, dtype)
+    return _angleFromTrace(np.trace(Rs, axis1=-2, axis2=-1))
+
+def geodesicDistancesSO3(R1s, R2s, dtype=None):
+    """ Element-wise distances between (N, 3, 3) stacks. Either argument can
+    also be a single (3, 3) matrix, giving one-to-many distances. """
+    R1s = _asStack(R1s, dtype)
+    R2s = _asStack(R2s, R1s.dtype)
+    # trace(R1 R2^T) is the sum of the element-wise product.
+    return _angleFromTrace(np.sum(R1s * R2s, axis=(-2, -1)))
+
+def geodesicDistanceMatrixSO3(R1s, R2s=None, dtype=None):
+    """ (N, M) matrix of distances between all pairs of (N, 3, 3) R1s and
+    (M, 3, 3) R2s; R2s defaults to R1s. """
+    R1s = _asStack(R1s, dtype)
+    R2s = R1s if R2s is None else _asStack(R2s, R1s.dtype)
+    traces = np.dot(R1s.reshape((-1, 9)), R2s.reshape((-1, 9)).T)
+    return _angleFromTrace(traces)
+
+def _cross2Matrices(w):
+    """ (N, 3) -> (N, 3, 3) skew-symmetric matrices. """
+    M = np.zeros((w.shape[0], 3, 3), dtype=w.dtype)
+    M[:, 0, 1] = -w[:, 2]
+    M[:, 0, 2] = w[:, 1]
+    M[:, 1, 0] = w[:, 2]
+    M[:, 1, 2] = -w[:, 0]
+    M[:, 2, 0] = -w[:, 1]
+    M[:, 2, 1] = w[:, 0]
+    return M
+
+def expSO3(w):
+    """ Rodrigues' formula for a rotation vector (3,) or a batch of them
+    (N, 3). Uses Taylor expansions of the coefficients for small angles. """
+    w = np.asarray(w, dtype=float)
+    single = w.ndim == 1
+    w = w.reshape((-1, 3))
+    theta_sq = np.sum(w * w, axis=1)
+    theta = np.sqrt(theta_sq)
+    small = theta < 1e-4
+    safe_theta = np.where(small, 1., theta)
+    a = np.where(small, 1. - theta_sq / 6., np.sin(theta) / safe_theta)
+    b = np.where(small, .5 - theta_sq / 24.,
+                 (1. - np.cos(theta)) / (safe_theta * safe_theta))
+    M = _cross2Matrices(w)
+    R = np.eye(3) + a[:, np.newaxis, np.newaxis] * M + \
+        b[:, np.newaxis, np.newaxis] * np.matmul(M, M)
+    return R[0] if single else R
+
+def logSO3(R):
+    """ Inverse of expSO3 for a rotation matrix (3, 3) or a batch of them
+    (N, 3, 3); returns rotation vectors with angle in [0, pi]. Close to pi,
+    the axis is recovered from the symmetric part of R rather than from the
+    vanishing skew-symmetric part. """
+    R = np.asarray(R, dtype=float)
+    single = R.ndim == 2
+    R = R.reshape((-1, 3, 3))
+    cos_theta = np.clip((np.trace(R, axis1=1, axis2=2) - 1) / 2, -1., 1.)
+    # 2 sin(theta) * axis
+    skew = np.stack((R[:, 2, 1] - R[:, 1, 2],
+                     R[:, 0, 2] - R[:, 2, 0],
+                     R[:, 1, 0] - R[:, 0, 1]), axis=1)
+    sin_theta = np.linalg.norm(skew, axis=1) / 2
+    # More accurate than arccos close to 0 and pi:
+    theta = np.arctan2(sin_theta, cos_theta)
+
+    small = theta < 1e-4
+    near_pi = theta > np.pi - 1e-3
+    # sin(theta) vanishes at pi too; those rows are overwritten below.
+    safe_sin = np.where(small | near_pi, 1., sin_theta)
+    scale = np.where(small, .5 + theta * theta / 12., theta / (2 * safe_sin))
+    w = scale[:, np.newaxis] * skew
+
+    if np.any(near_pi):
+        Rp = R[near_pi]
+        # (R + R^T) / 2 - cos(theta) I = (1 - cos(theta)) * axis * axis^T
+        B = (Rp + np.swapaxes(Rp, 1, 2)) / 2 - \
+            cos_theta[near_pi, np.newaxis, np.newaxis] * np.eye(3)
+        k = np.argmax(np.diagonal(B, axis1=1, axis2=2), axis=1)
+        n = np.arange(Rp.shape[0])
+        axis = B[n, :, k]
+        axis = axis / np.linalg.norm(axis, axis=1, keepdims=True)
+        sign = np.where(np.sum(axis * skew[near_pi], axis=1) < 0, -1., 1.)
+        w[near_pi] = (sign * theta[near_pi])[:, np.newaxis] * axis
+    return w[0] if single else w
@@ -19,7 +19,6 @@
 
 import numpy as np
 import pyquaternion
-import scipy.linalg
 
 from rpg_common_py import geometry
 
@@ -53,6 +52,10 @@ class Pose(object):
         # If the right operand is a pose, return the chained poses.
         if isinstance(other, Pose):
             return Pose(np.dot(self.R, other.R), np.dot(self.R, other.t) + self.t)
+        # If it is a pose array, chain this pose with every pose in it.
+        if isinstance(other, PoseArray):
+            return PoseArray(np.matmul(self.R, other.R),
+                             np.dot(other.t, self.R.T) + self.t.T)
         # If it is a vector or several vectors expressed as matrix, apply the
         # pose transformation to them.
         if type(other) is np.ndarray or\
@@ -67,12 +70,84 @@ class Pose(object):
         return np.vstack((np.hstack((self.R, self.t)), np.array([0,0,0,1])))
 
     def asTwist(self):
-        so_matrix = scipy.linalg.logm(self.R)
-        if np.sum(np.imag(so_matrix)) > 1e-10:
-            raise Exception('logm called for a matrix with angle Pi. ' +
-                'Not defined! Consider using another representation!')
-        so_matrix = np.real(so_matrix)
-        return np.hstack((np.ravel(self.t), matrix2Cross(so_matrix)))
+        """ Translation and rotation vector, inverse of fromTwist(). """
+        return np.hstack((np.ravel(self.t), geometry.logSO3(self.R)))
+
+
+class PoseArray(object):
+    """ N poses stored as contiguous (N, 3, 3) rotation and (N, 3)
+    translation arrays, such that operations on whole trajectories are
+    batched rather than executed one Pose at a time. Indexing with an integer
+    returns a Pose, indexing with a slice, index array or mask returns a
+    PoseArray. """
+    def __init__(self, R, t):
+        assert type(R) is np.ndarray
+        assert type(t) is np.ndarray
+        assert R.ndim == 3 and R.shape[1:] == (3, 3)
+        assert t.shape == (R.shape[0], 3)
+        self.R = np.ascontiguousarray(R)
+        self.t = np.ascontiguousarray(t)
+
+    def __len__(self):
+        return self.R.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return Pose(self.R[item], self.t[item].reshape(3, 1))
+        return PoseArray(self.R[item], self.t[item])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def inverse(self):
+        R_inv = np.swapaxes(self.R, 1, 2)
+        return PoseArray(R_inv, -np.einsum('nij,nj->ni', R_inv, self.t))
+
+    def __mul__(self, other):
+        # Chain with another pose array (element-wise, or broadcast if either
+        # has length 1) or with a single pose.
+        if isinstance(other, Pose):
+            other = PoseArray(other.R[np.newaxis], other.t.reshape(1, 3))
+        if isinstance(other, PoseArray):
+            R = np.matmul(self.R, other.R)
+            t = np.einsum('nij,nj->ni', self.R, other.t) + self.t
+            return PoseArray(R, t)
+        # Points: (3, M) are transformed by every pose, resulting in
+        # (N, 3, M); (N, 3, M) are transformed by their respective pose.
+        if type(other) is np.ndarray:
+            assert other.ndim in [2, 3]
+            assert other.shape[-2] == 3
+            return np.matmul(self.R, other) + self.t[:, :, np.newaxis]
+
+        raise Exception('Multiplication with unknown type!')
+
+    def asArray(self):
+        result = np.zeros((len(self), 4, 4))
+        result[:, :3, :3] = self.R
+        result[:, :3, 3] = self.t
+        result[:, 3, 3] = 1
+        return result
+
+    def toPoses(self):
+        return [self[i] for i in range(len(self))]
+
+    def asTwist(self):
+        """ (N, 6) array of translations and rotation vectors. """
+        return np.hstack((self.t, geometry.logSO3(self.R)))
+
+
+def fromPoses(poses):
+    if isinstance(poses, PoseArray):
+        return poses
+    R = np.array([i.R for i in poses]).reshape((-1, 3, 3))
+    t = np.array([np.ravel(i.t) for i in poses]).reshape((-1, 3))
+    return PoseArray(R, t)
+
+
+def fromMatrices(M):
+    """ M is (N, 3, 4) or (N, 4, 4). """
+    return PoseArray(M[:, :3, :3], M[:, :3, 3])
 
 
 def fromMatrix(M):
@@ -84,14 +159,29 @@ def fromApproximateMatrix(M):
 
 
 def fromTwist(twist):
-    # Using Rodrigues' formula
-    w = twist[3:]
-    theta = np.linalg.norm(w)
-    if theta < 1e-6:
-        return Pose(np.eye(3), twist[:3].reshape(3, 1))
-    M = cross2Matrix(w/theta)
-    R = np.eye(3) + M * np.sin(theta) + np.dot(M, M) * (1 - np.cos(theta))
-    return Pose(R, twist[:3].reshape(3, 1))
+    """ twist is (6,), returning a Pose, or (N, 6), returning a PoseArray. """
+    twist = np.asarray(twist)
+    if twist.ndim == 2:
+        return PoseArray(geometry.expSO3(twist[:, 3:]), twist[:, :3].copy())
+    return Pose(geometry.expSO3(twist[3:]), twist[:3].reshape(3, 1))
+
+
+def quaternionsToRotations(q_wxyz):
+    """ Batched equivalent of pyquaternion's rotation_matrix for (N, 4)
+    quaternions in w, x, y, z order. """
+    q = q_wxyz / np.linalg.norm(q_wxyz, axis=1, keepdims=True)
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    R = np.empty((q.shape[0], 3, 3))
+    R[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    R[:, 0, 1] = 2 * (x * y - w * z)
+    R[:, 0, 2] = 2 * (x * z + w * y)
+    R[:, 1, 0] = 2 * (x * y + w * z)
+    R[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    R[:, 1, 2] = 2 * (y * z - w * x)
+    R[:, 2, 0] = 2 * (x * z - w * y)
+    R[:, 2, 1] = 2 * (y * z + w * x)
+    R[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    return R
 
 
 # ROS geometry_msgs/Pose
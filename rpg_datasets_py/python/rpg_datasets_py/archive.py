@@ -0,0 +1,172 @@
+# Copyright (C) 2019 Titus Cieslewski, RPG, University of Zurich, Switzerland
+#   You can contact the author at <titus at ifi dot uzh dot ch>
+# Copyright (C) 2019 Davide Scaramuzza, RPG, University of Zurich, Switzerland
+#
+# This file is part of imips_open_deps.
+#
+# imips_open_deps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# imips_open_deps is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with imips_open_deps. If not, see <http:#www.gnu.org/licenses/>.
+
+# Single-file archive of compressed frames, for datasets that are too large
+# to be packed raw (see packed.py). Layout:
+#
+#   magic | num_records, meta_offset, meta_size (uint64) |
+#   record offsets (num_records + 1 x uint64) | records... | meta (npz)
+#
+# Records are the compressed frames, left frames first, then right frames.
+# The offset index is read once on construction, after which any frame is
+# read with a single positional read on one shared file descriptor.
+
+import cv2
+import io
+import numpy as np
+import os
+import struct
+import threading
+import zlib
+
+from rpg_common_py import pose
+import rpg_datasets_py.base as base
+import rpg_datasets_py.packed as packed
+
+_MAGIC = b'RPGARCH1'
+_HEADER = struct.Struct('<8sQQQ')
+codecs = ['png', 'jpg', 'zlib']
+
+
+def _encode(img, codec, jpeg_quality):
+    if codec == 'png':
+        return cv2.imencode('.png', img)[1].tobytes()
+    if codec == 'jpg':
+        return cv2.imencode(
+            '.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1].tobytes()
+    assert codec == 'zlib'
+    return zlib.compress(np.ascontiguousarray(img).tobytes(), 1)
+
+
+def write(sequence, path, codec='png', jpeg_quality=95):
+    """ Frames are obtained with sequence.image() (and rightImage() for
+    stereo sequences). zlib is lossless and faster to decode than png, but
+    requires all frames to have the same shape. """
+    assert codec in codecs
+    stereo = isinstance(sequence, base.RectifiedStereoSequence)
+    getters = [sequence.image, sequence.rightImage] if stereo \
+        else [sequence.image]
+    num_records = len(getters) * len(sequence)
+    offsets = np.zeros(num_records + 1, dtype=np.uint64)
+    shape = None
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.seek(_HEADER.size + offsets.nbytes)
+        record_i = 0
+        for getter in getters:
+            for i in range(len(sequence)):
+                img = getter(i)
+                if shape is None:
+                    shape = img.shape
+                elif codec == 'zlib':
+                    assert img.shape == shape
+                offsets[record_i] = f.tell()
+                f.write(_encode(img, codec, jpeg_quality))
+                record_i += 1
+        offsets[-1] = f.tell()
+
+        meta = packed.sequenceMeta(sequence)
+        meta['codec'] = np.asarray(codec)
+        meta['shape'] = np.asarray(shape)
+        meta_bytes = io.BytesIO()
+        np.savez(meta_bytes, **meta)
+        meta_bytes = meta_bytes.getvalue()
+        f.write(meta_bytes)
+
+        f.seek(0)
+        f.write(_HEADER.pack(_MAGIC, num_records, int(offsets[-1]),
+                             len(meta_bytes)))
+        f.write(offsets.tobytes())
+    os.rename(tmp_path, path)
+
+
+class ArchiveSequence(base.RectifiedStereoSequence):
+    """ Sequence read from an archive written with write(). __getitem__
+    returns decoded frames; use setDecoding() to enable an LRU cache.
+    images and right_images contain the original frame names. As in
+    packed.PackedSequence, missing attributes are None. """
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._fd_lock = threading.Lock()
+        with open(path, 'rb') as f:
+            magic, num_records, meta_offset, meta_size = _HEADER.unpack(
+                f.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise Exception('%s is not an archive!' % path)
+            self._offsets = np.frombuffer(
+                f.read(8 * (num_records + 1)), dtype=np.uint64).astype(np.int64)
+            f.seek(meta_offset)
+            meta = np.load(io.BytesIO(f.read(meta_size)))
+
+        def optional(key):
+            return meta[key] if key in meta.files else None
+
+        names = [str(i) for i in meta['names']]
+        stereo = num_records == 2 * len(names)
+        T_W_C = optional('T_W_C')
+        if T_W_C is not None:
+            T_W_C = pose.fromMatrices(T_W_C)
+        baseline = optional('baseline')
+        base.RectifiedStereoSequence.__init__(
+            self, names, names if stereo else None, optional('K'),
+            optional('right_K'), T_W_C,
+            None if baseline is None else float(baseline),
+            str(meta['set_name']), str(meta['seq_name']))
+        self.codec = str(meta['codec'])
+        self.shape = tuple(meta['shape'])
+        self.setDecoding(cache_bytes=0)
+
+    def __getstate__(self):
+        # File descriptors don't survive pickling, e.g. to worker processes.
+        state = self.__dict__.copy()
+        state['_fd'] = None
+        del state['_fd_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._fd_lock = threading.Lock()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if getattr(self, '_fd', None) is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read(self, record_i):
+        start, end = self._offsets[record_i], self._offsets[record_i + 1]
+        with self._fd_lock:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDONLY)
+            if not hasattr(os, 'pread'):
+                os.lseek(self._fd, start, os.SEEK_SET)
+                return os.read(self._fd, end - start)
+        return os.pread(self._fd, end - start, start)
+
+    def _decodeImage(self, i, right):
+        data = self._read(i + len(self) if right else i)
+        if self.codec == 'zlib':
+            return np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(
+                self.shape)
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+                            cv2.IMREAD_UNCHANGED)
@@ -17,36 +17,107 @@
 # You should have received a copy of the GNU General Public License
 # along with imips_open_deps. If not, see <http:#www.gnu.org/licenses/>.
 
+import cv2
 import numpy as np
 
+from rpg_common_py import geometry
+from rpg_common_py import pose
+
+from rpg_datasets_py.utils.cache import LRUCache
+
 
 class ImageSequence(object):
     def __init__(self, images, set_name, seq_name):
         self.images = images
         self.set_name = set_name
         self.seq_name = seq_name
+        self.image_cache = None
+        self._decode = False
+        self._imread_flags = cv2.IMREAD_GRAYSCALE
 
     def __len__(self):
         return len(self.images)
 
     def __getitem__(self, item):
-        return self.images[item]
+        if not self._decode:
+            return self.images[item]
+        if isinstance(item, slice):
+            return [self.image(i) for i in range(*item.indices(len(self)))]
+        return self.image(item)
 
     def name(self):
         return '%s%s' % (self.set_name, self.seq_name)
 
+    def setDecoding(self, decode=True, color=False, cache_bytes=512 * 2 ** 20):
+        """ Opt-in: if decode is set, __getitem__ returns decoded images rather
+        than paths. Decoded images are kept in an LRU cache of at most
+        cache_bytes (no cache if 0), see image_cache.stats(). """
+        self._decode = decode
+        flags = cv2.IMREAD_COLOR if color else cv2.IMREAD_GRAYSCALE
+        if flags != self._imread_flags and self.image_cache is not None:
+            self.image_cache.clear()
+        self._imread_flags = flags
+        if cache_bytes > 0:
+            if self.image_cache is None:
+                self.image_cache = LRUCache(cache_bytes)
+            self.image_cache.max_bytes = cache_bytes
+        else:
+            self.image_cache = None
+
+    def image(self, i):
+        """ Decoded image i, regardless of whether decoding is enabled for
+        __getitem__. """
+        return self._cachedImage(i, False)
+
+    def _cachedImage(self, i, right):
+        if i < 0:
+            i += len(self)
+        if self.image_cache is None:
+            return self._decodeImage(i, right)
+        return self.image_cache.getOrCompute(
+            (right, i), lambda: self._decodeImage(i, right))
+
+    def _decodeImage(self, i, right):
+        """ Override this for sequences whose frames are not plain image
+        files. """
+        path = self.right_images[i] if right else self.images[i]
+        img = cv2.imread(path, self._imread_flags)
+        if img is None:
+            raise IOError('Could not read image %s!' % path)
+        return img
+
 
 class RectifiedMonoSequence(ImageSequence):
     def __init__(self, images, K, T_W_C, set_name, seq_name):
+        """ T_W_C can be a list of poses or a pose.PoseArray. """
         ImageSequence.__init__(self, images, set_name, seq_name)
         self.K = K
         self.T_W_C = T_W_C
 
+    def poseArray(self):
+        if not isinstance(self.T_W_C, pose.PoseArray):
+            self.T_W_C = pose.fromPoses(self.T_W_C)
+        return self.T_W_C
+
     def positions(self):
-        return np.array([np.ravel(i.t) for i in self.T_W_C])
+        return self.poseArray().t.copy()
 
     def getT_A_B(self, indices):
-        return self.T_W_C[indices[0]].inverse() * self.T_W_C[indices[1]]
+        """ indices can be a pair of frame indices, returning a Pose, or a
+        pair of index arrays, returning a PoseArray. """
+        T_W_C = self.poseArray()
+        return T_W_C[indices[0]].inverse() * T_W_C[indices[1]]
+
+    def spatialIndex(self):
+        """ spatial.SpatialIndex over the positions of this sequence. Built
+        on first use and rebuilt if the poses have changed since. """
+        positions = self.positions()
+        index = getattr(self, '_spatial_index', None)
+        if index is None or not np.array_equal(index.positions, positions):
+            import rpg_datasets_py.spatial as spatial
+            index = spatial.SpatialIndex(positions)
+            self._spatial_index = index
+        return index
 
 
 class RectifiedStereoSequence(RectifiedMonoSequence):
@@ -58,5 +129,151 @@ class RectifiedStereoSequence(RectifiedMonoSequence):
         self.right_K = right_K
         self.baseline = baseline
 
+    def rightImage(self, i):
+        return self._cachedImage(i, True)
+
+
+class TimedTrajectory(object):
+    """ Poses indexed by timestamps, kept sorted such that queries for
+    arbitrary arrays of times are answered with binary search. """
+    def __init__(self, times, T_W_X):
+        times = np.asarray(times)
+        T_W_X = pose.fromPoses(T_W_X)
+        assert len(times) == len(T_W_X)
+        assert len(times) > 0
+        order = np.argsort(times, kind='mergesort')
+        self.times = times[order]
+        self.T_W_X = T_W_X[order]
+
+    def __len__(self):
+        return len(self.times)
+
+    def nearestIndices(self, query_times):
+        """ On ties, the earlier pose is picked, like np.argmin() would. """
+        query_times = np.asarray(query_times)
+        if len(self) == 1:
+            return np.zeros(query_times.shape, dtype=int)
+        upper = np.clip(np.searchsorted(self.times, query_times), 1,
+                        len(self) - 1)
+        lower = upper - 1
+        upper_closer = np.abs(self.times[upper] - query_times) < \
+            np.abs(self.times[lower] - query_times)
+        return np.where(upper_closer, upper, lower)
+
+    def nearest(self, query_times):
+        return self.T_W_X[self.nearestIndices(np.ravel(query_times))]
+
+    def interpolate(self, query_times):
+        """ Linear interpolation of translation and SLERP of rotation between
+        the two poses enclosing each query time. Raises for query times
+        outside of the trajectory. """
+        query_times = np.ravel(query_times)
+        if np.any(query_times < self.times[0]) or \
+                np.any(query_times > self.times[-1]):
+            raise ValueError('Query times outside of trajectory [%s, %s]!' %
+                             (self.times[0], self.times[-1]))
+        if len(self) == 1:
+            return self.T_W_X[np.zeros(len(query_times), dtype=int)]
+        upper = np.clip(np.searchsorted(self.times, query_times, side='right'),
+                        1, len(self) - 1)
+        lower = upper - 1
+        alpha = (query_times - self.times[lower]).astype(float) / \
+            (self.times[upper] - self.times[lower])
+
+        T_W_L = self.T_W_X[lower]
+        T_W_U = self.T_W_X[upper]
+        t = (1 - alpha)[:, np.newaxis] * T_W_L.t + \
+            alpha[:, np.newaxis] * T_W_U.t
+        w_L_U = geometry.logSO3(np.matmul(np.swapaxes(T_W_L.R, 1, 2), T_W_U.R))
+        R = np.matmul(T_W_L.R,
+                      geometry.expSO3(alpha[:, np.newaxis] * w_L_U))
+        return pose.PoseArray(R, t)
+
+
+class ConcatSequence(object):
+    """ Several sequences behind one flat, global frame index. Mapping between
+    global and per-sequence indices and sampling are vectorized and don't
+    loop over sequences. """
+    def __init__(self, sequences):
+        assert len(sequences) > 0
+        self.sequences = sequences
+        self.lengths = np.array([len(i) for i in sequences])
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths)))
+        # Sequence index of every global frame, for O(1) lookup.
+        self._seq_of_frame = np.repeat(
+            np.arange(len(sequences)), self.lengths)
+        self.setSequenceWeights(None)
+
+    @staticmethod
+    def build(constructor, seq_ids, num_threads=None):
+        """ Constructs constructor(seq_id) for all seq_ids on a thread pool,
+        since construction is dominated by file system access. """
+        import multiprocessing.pool
+        pool = multiprocessing.pool.ThreadPool(
+            num_threads if num_threads is not None else len(seq_ids))
+        try:
+            return ConcatSequence(pool.map(constructor, seq_ids))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, item):
+        seq_i, local_i = self.globalToLocal(item)
+        return self.sequences[seq_i][local_i]
+
+    def globalToLocal(self, global_indices):
+        """ Returns sequence indices and indices within these sequences.
+        Negative global indices count from the end. """
+        global_indices = np.asarray(global_indices)
+        global_indices = np.where(
+            global_indices < 0, global_indices + len(self), global_indices)
+        if np.any((global_indices < 0) | (global_indices >= len(self))):
+            raise IndexError('Global index out of range!')
+        seq_indices = self._seq_of_frame[global_indices]
+        return seq_indices, global_indices - self.offsets[seq_indices]
+
+    def localToGlobal(self, seq_indices, local_indices):
+        return self.offsets[seq_indices] + local_indices
+
+    def setSequenceWeights(self, weights):
+        """ Relative probability of sampling from each sequence, or None to
+        sample all frames uniformly. Sets up an alias table (Vose) such that
+        each sample takes constant time. """
+        if weights is None:
+            self._alias = None
+            return
+        weights = np.asarray(weights, dtype=float)
+        assert weights.shape == (len(self.sequences),)
+        assert np.all(weights >= 0) and np.sum(weights) > 0
+        n = len(weights)
+        scaled = weights * n / np.sum(weights)
+        prob = np.ones(n)
+        alias = np.arange(n)
+        small = [i for i in range(n) if scaled[i] < 1]
+        large = [i for i in range(n) if scaled[i] >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        self._alias = (prob, alias)
+
+    def sample(self, num_samples, rng=np.random):
+        """ Returns global indices of random frames; uniform over all frames
+        unless sequence weights have been set. """
+        if self._alias is None:
+            return rng.randint(len(self), size=num_samples)
+        prob, alias = self._alias
+        columns = rng.randint(len(prob), size=num_samples)
+        seq_indices = np.where(rng.random_sample(num_samples) < prob[columns],
+                               columns, alias[columns])
+        local_indices = (rng.random_sample(num_samples) *
+                         self.lengths[seq_indices]).astype(int)
+        return self.localToGlobal(seq_indices, local_indices)
+
 
 tvt = ['training', 'validation', 'testing']
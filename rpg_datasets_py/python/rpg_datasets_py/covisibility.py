@@ -0,0 +1,113 @@
+# Copyright (C) 2019 Titus Cieslewski, RPG, University of Zurich, Switzerland
+#   You can contact the author at <titus at ifi dot uzh dot ch>
+# Copyright (C) 2019 Davide Scaramuzza, RPG, University of Zurich, Switzerland
+#
+# This file is part of imips_open_deps.
+#
+# imips_open_deps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# imips_open_deps is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with imips_open_deps. If not, see <http:#www.gnu.org/licenses/>.
+
+# Estimates which frames of a sequence see the same scene, from poses and
+# intrinsics only: points are sampled in the frustum of each frame (a pixel
+# grid at a few depths) and projected into the other frames. Frames are
+# processed in blocks, such that memory use is bounded by block_size rather
+# than by the sequence length.
+
+import numpy as np
+import scipy.sparse
+
+
+def frustumSamples(K, image_shape, depths, grid):
+    """ (3, grid * grid * len(depths)) points in the camera frame. """
+    h, w = image_shape[:2]
+    u, v = np.meshgrid((np.arange(grid) + .5) * w / grid,
+                       (np.arange(grid) + .5) * h / grid)
+    rays = np.dot(np.linalg.inv(K),
+                  np.vstack((u.ravel(), v.ravel(), np.ones(u.size))))
+    return np.hstack([rays * d for d in depths])
+
+
+def _visibleFraction(P_W, T_C_W, K, image_shape):
+    """ For (b, 3, M) world points of b frames and c target poses, the
+    (c, b) fraction of each frame's points that each target sees. """
+    P_C = np.einsum('cij,bjm->cbim', T_C_W.R, P_W) + \
+        T_C_W.t[:, np.newaxis, :, np.newaxis]
+    z = P_C[:, :, 2, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = K[0, 0] * P_C[:, :, 0, :] / z + K[0, 2]
+        v = K[1, 1] * P_C[:, :, 1, :] / z + K[1, 2]
+    h, w = image_shape[:2]
+    inside = (z > 0) & (u >= 0) & (u < w) & (v >= 0) & (v < h)
+    return inside.mean(axis=2)
+
+
+def overlapMatrix(sequence, image_shape=None, depths=(5., 10., 20.),
+                  grid=8, min_overlap=0.1, block_size=64, max_distance=None):
+    """ Sparse (N, N) matrix whose entry (i, j) is the fraction of the
+    frustum samples of frame i that are seen by frame j, for all i != j with
+    at least min_overlap. depths should reflect the scene depth of the
+    dataset. image_shape defaults to the shape of the first image. If
+    max_distance is given, only frames whose positions are at most that far
+    apart are compared (using the spatial index of the sequence), which is
+    much faster for long sequences. """
+    if image_shape is None:
+        image_shape = sequence.image(0).shape
+    K = sequence.K
+    T_W_C = sequence.poseArray()
+    T_C_W = T_W_C.inverse()
+    n = len(T_W_C)
+    P_C = frustumSamples(K, image_shape, depths, grid)
+    if max_distance is not None:
+        index = sequence.spatialIndex()
+
+    rows, cols, values = [], [], []
+    for start in range(0, n, block_size):
+        sources = np.arange(start, min(start + block_size, n))
+        P_W = T_W_C[sources] * P_C
+        if max_distance is None:
+            targets = np.arange(n)
+        else:
+            targets = np.unique(np.concatenate(index.radius(
+                T_W_C.t[sources], max_distance)))
+        for target_start in range(0, len(targets), block_size):
+            block_targets = targets[target_start:target_start + block_size]
+            fraction = _visibleFraction(
+                P_W, T_C_W[block_targets], K, image_shape)
+            t_i, s_i = np.nonzero(fraction >= min_overlap)
+            keep = sources[s_i] != block_targets[t_i]
+            rows.append(sources[s_i[keep]])
+            cols.append(block_targets[t_i[keep]])
+            values.append(fraction[t_i[keep], s_i[keep]])
+
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n, n))
+
+
+def saveOverlap(path, overlap):
+    scipy.sparse.save_npz(path, overlap)
+
+
+def loadOverlap(path):
+    return scipy.sparse.load_npz(path).tocsr()
+
+
+def samplePairs(overlap, num_pairs, min_overlap=0., rng=np.random):
+    """ (num_pairs, 2) random frame pairs, uniform among the pairs with at
+    least min_overlap, to be used with getT_A_B(). """
+    overlap = overlap.tocoo()
+    valid = overlap.data >= min_overlap
+    assert np.any(valid)
+    chosen = rng.randint(np.count_nonzero(valid), size=num_pairs)
+    return np.stack((overlap.row[valid][chosen], overlap.col[valid][chosen]),
+                    axis=1)
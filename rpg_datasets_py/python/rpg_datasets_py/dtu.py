@@ -18,8 +18,6 @@
 # along with imips_open_deps. If not, see <http:#www.gnu.org/licenses/>.
 
 import cv2
-import hickle as hkl
-import IPython
 import numpy as np
 import os
 import scipy.io
@@ -27,13 +25,22 @@ import scipy.io
 from rpg_common_py import pose
 
 import rpg_datasets_py.base as base
+import rpg_datasets_py.utils.metadata_cache as metadata_cache
+from rpg_datasets_py.utils.cache import LRUCache
 from rpg_datasets_py.utils.symlink import symlink
+import rpg_datasets_py.utils.path as utils_path
+
+
+# Process-wide, shared by all sequences (and light conditions) of a scan.
+# The calibration is small, so only the point clouds count towards the bound.
+shared_cache = LRUCache(2 * 2 ** 30)
 
 
 class Calibration(object):
     def __init__(self):
         mat_path = os.path.join(symlink('dtu'), 'calibrationFile.mat')
-        self.mat = scipy.io.loadmat(mat_path)
+        self.mat = shared_cache.getOrCompute(
+            'calibration', lambda: scipy.io.loadmat(mat_path))
 
     def getK(self, half):
         c = self.mat['cc']
@@ -53,11 +60,32 @@ class Calibration(object):
         return [i.inverse() for i in T_C_W]
 
 
-def pointCloud(seq_i):
+def _loadPointCloud(mat_path, dtype):
+    mat = scipy.io.loadmat(mat_path)
+    return np.hstack((mat['pts3D_near'][:3, :],
+                      mat['pts3D_far'][:3, :])).astype(dtype)
+
+
+def pointCloud(seq_i, mmap=False, dtype=np.float64):
+    """ (3, N), read-only and shared between callers. With mmap, the cloud
+    is converted once to a .npy in the metadata cache and memory-mapped from
+    there, e.g. with dtype=np.float32 to halve its size. """
     mat_path = os.path.join(symlink('dtu'), 'reconstructions',
                             'Clean_Reconstruction_%02d.mat' % seq_i)
-    mat = scipy.io.loadmat(mat_path)
-    return np.hstack((mat['pts3D_near'][:3, :], mat['pts3D_far'][:3, :]))
+    dtype = np.dtype(dtype)
+
+    def load():
+        if mmap:
+            # Plain ndarray view of the memory map, as expected by Pose.
+            return np.asarray(metadata_cache.cachedMemmap(
+                'dtu_cloud_%02d_%s' % (seq_i, dtype.name), [mat_path],
+                lambda: {'points': _loadPointCloud(mat_path, dtype)})[
+                'points'])
+        points = _loadPointCloud(mat_path, dtype)
+        points.flags.writeable = False
+        return points
+
+    return shared_cache.getOrCompute((seq_i, mmap, dtype.name), load)
 
 
 def project(P_C, K):
@@ -70,10 +98,101 @@ def inside(rc, im):
     return 0 <= rc[0] < im.shape[0] and 0 <= rc[1] < im.shape[1]
 
 
+def observedPoints(P_W, T_C_W, K, image_shape, chunk_size=2 ** 20):
+    """ Z-buffer: id of the nearest point projecting into each pixel, -1
+    where no point projects. Points are processed in chunks to bound
+    memory; on equal depth, the lower point id wins. """
+    h, w = image_shape
+    depths = np.zeros(h * w)
+    ids = -np.ones(h * w, dtype=int)
+    for start in range(0, P_W.shape[1], chunk_size):
+        P_C = T_C_W * P_W[:, start:start + chunk_size]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p_C = project(P_C, K)
+        valid = np.all(np.isfinite(p_C), axis=0)
+        # int() truncates towards zero:
+        rc = np.zeros((2, p_C.shape[1]), dtype=int)
+        rc[:, valid] = np.trunc(p_C[::-1, valid])
+        valid &= (rc[0] >= 0) & (rc[0] < h) & (rc[1] >= 0) & (rc[1] < w)
+        chunk_ids = np.nonzero(valid)[0]
+        pixels = rc[0, chunk_ids] * w + rc[1, chunk_ids]
+        z = P_C[2, chunk_ids]
+        # Nearest point per pixel: sort by pixel, then depth, then id.
+        order = np.lexsort((chunk_ids, z, pixels))
+        pixels = pixels[order]
+        first = np.ones(len(pixels), dtype=bool)
+        first[1:] = pixels[1:] != pixels[:-1]
+        pixels = pixels[first]
+        z = z[order][first]
+        chunk_ids = chunk_ids[order][first] + start
+        # Points of earlier chunks have lower ids and win ties.
+        closer = (z < depths[pixels]) | (depths[pixels] == 0.)
+        depths[pixels[closer]] = z[closer]
+        ids[pixels[closer]] = chunk_ids[closer]
+
+    return ids.reshape((h, w))
+
+
+def imageShape(half):
+    return (600, 800) if half else (1200, 1600)
+
+
+def _seqPath(seq_i, half):
+    return os.path.join(
+        symlink('dtu'), 'half' if half else 'full', 'SET%03d' % seq_i)
+
+
+class PointIds(object):
+    """ point_ids[frame_i] is the (h, w) image of the ids of the points
+    observed in each pixel, -1 where there is none. Stored sparsely as int32
+    (pixel, id) pairs of all frames in one memory-mapped .npy, with the
+    per-frame offsets in a second file; frames are decoded on first
+    access. """
+    def __init__(self, path, image_shape):
+        self.image_shape = image_shape
+        self.pairs = np.load(path + '.npy', mmap_mode='r')
+        self.offsets = np.load(path + '_offsets.npy')
+        self._frames = {}
+
+    @staticmethod
+    def exists(path):
+        # The offsets are written last.
+        return os.path.exists(path + '_offsets.npy')
+
+    @staticmethod
+    def write(path, frames):
+        """ frames: iterable of dense id images. """
+        pairs = []
+        offsets = [0]
+        for ids in frames:
+            ids = np.ravel(ids)
+            pixels = np.nonzero(ids >= 0)[0]
+            pairs.append(np.vstack((pixels, ids[pixels])).astype(np.int32))
+            offsets.append(offsets[-1] + len(pixels))
+        utils_path.saveNpyAtomic(path + '.npy', np.hstack(pairs))
+        utils_path.saveNpyAtomic(path + '_offsets.npy', np.array(offsets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, frame_i):
+        frame_i = range(len(self))[frame_i]
+        if frame_i not in self._frames:
+            start, end = self.offsets[frame_i:frame_i + 2]
+            ids = -np.ones(self.image_shape, dtype=np.int32)
+            ids.flat[self.pairs[0, start:end]] = self.pairs[1, start:end]
+            self._frames[frame_i] = ids
+        return self._frames[frame_i]
+
+
 class SameLightSequence(base.RectifiedMonoSequence):
-    def __init__(self, seq_i, light_i, half=True):
+    def __init__(self, seq_i, light_i, half=True,
+                 depth_cache_bytes=256 * 2 ** 20, mmap_points=False,
+                 points_dtype=np.float64):
+        """ See pointCloud() for mmap_points and points_dtype. """
         half_full = 'half' if half else 'full'
-        seq_path = os.path.join(symlink('dtu'), half_full, 'SET%03d' % seq_i)
+        self.image_shape = imageShape(half)
+        seq_path = _seqPath(seq_i, half)
         im_names = ['Img%03d_%02d.bmp' % (i, light_i) for i in range(1, 120)]
         im_paths = [os.path.join(seq_path, i) for i in im_names]
 
@@ -83,44 +202,48 @@ class SameLightSequence(base.RectifiedMonoSequence):
             self, im_paths, calib.getK(half), calib.getT_W_C(),
             'dtu_%s' % half_full, '%03d_%02d' % (seq_i, light_i))
         self.T_C_W = [i.inverse() for i in self.T_W_C]
+        self.depth_cache = LRUCache(depth_cache_bytes)
 
-        self.points = pointCloud(seq_i)
-        point_ids_file = os.path.join(seq_path, 'point_ids.hkl')
-        if not os.path.exists(point_ids_file):
-            self.point_ids = [
-                self.calculateObservedPoints(i) for i in range(119)]
-            hkl.dump(self.point_ids, open(point_ids_file, 'w'))
-        else:
-            self.point_ids = hkl.load(open(point_ids_file, 'r'))
+        self.points = pointCloud(seq_i, mmap_points, points_dtype)
+        point_ids_path = os.path.join(seq_path, 'point_ids')
+        if not PointIds.exists(point_ids_path):
+            legacy_file = point_ids_path + '.hkl'
+            if os.path.exists(legacy_file):
+                # Optional dependency, only needed to convert legacy files:
+                import hickle as hkl
+                frames = hkl.load(open(legacy_file, 'r'))
+            else:
+                frames = (self.calculateObservedPoints(i) for i in range(119))
+            PointIds.write(point_ids_path, frames)
+        self.point_ids = PointIds(point_ids_path, self.image_shape)
 
-    def calculateObservedPoints(self, frame_i):
+    def calculateObservedPoints(self, frame_i, chunk_size=2 ** 20):
         print('Observed points %d...' % frame_i)
-        P_C = self.T_C_W[frame_i] * self.points
-        p_C = project(P_C, self.K)
-
-        depths = np.zeros((600, 800))
-        ids = -np.ones((600, 800), dtype=int)
-        for i in range(p_C.shape[1]):
-            rc = [int(p_C[1, i]), int(p_C[0, i])]
-            if inside(rc, depths):
-                if P_C[2, i] < depths[rc[0], rc[1]] or \
-                        depths[rc[0], rc[1]] == 0.:
-                    depths[rc[0], rc[1]] = P_C[2, i]
-                    ids[rc[0], rc[1]] = i
-
-        return ids
+        return observedPoints(self.points, self.T_C_W[frame_i], self.K,
+                              self.image_shape, chunk_size)
 
     def depthImage(self, frame_i):
-        P_C = self.T_C_W[frame_i] * self.points
-
-        depths = np.zeros((600, 800))
-        for r in range(600):
-            for c in range(800):
-                if self.point_ids[frame_i][r, c] != -1:
-                    depths[r, c] = P_C[2, self.point_ids[frame_i][r, c]]
+        """ Depth of the observed point in each pixel, 0 where there is none.
+        Cached, see depth_cache.stats(). """
+        return self.depth_cache.getOrCompute(
+            frame_i, lambda: self._depthImage(frame_i))
 
+    def _depthImage(self, frame_i):
+        ids = self.point_ids[frame_i]
+        observed = ids >= 0
+        # Only the depth of the observed points is needed:
+        T_C_W = self.T_C_W[frame_i]
+        depths = np.zeros(ids.shape)
+        depths[observed] = np.dot(T_C_W.R[2], self.points[:, ids[observed]]) \
+            + T_C_W.t[2]
         return depths
 
+    def depthImages(self, frame_is=None):
+        """ Stack of depth images (n, h, w) for frame_is, all by default. """
+        if frame_is is None:
+            frame_is = range(len(self))
+        return np.stack([self.depthImage(i) for i in frame_is])
+
     def getCorrespondence(self, point_rc, src, dst):
         i = self.point_ids[src][point_rc[0], point_rc[1]]
         if i < 0:
@@ -128,17 +251,51 @@ class SameLightSequence(base.RectifiedMonoSequence):
         P_C = self.T_C_W[dst] * self.points[:, i:i+1]
         return np.flip(project(P_C, self.K).astype(int).flatten())
 
+    def getCorrespondences(self, points_rc, src, dsts, occlusion_tol=None):
+        """ Batched getCorrespondence: points_rc is (M, 2) pixels in frame
+        src, dsts a frame or a list of D frames. Returns (D, M, 2)
+        corresponding pixels and a (D, M) validity mask (without the D
+        dimension if dsts is a single frame). A correspondence is valid if
+        the source pixel observes a point that lies in front of and projects
+        into the destination frame. If occlusion_tol is given, it also must
+        not be more than a relative occlusion_tol behind the destination
+        depth image. """
+        single = np.isscalar(dsts)
+        dsts = np.atleast_1d(dsts)
+        points_rc = np.asarray(points_rc, dtype=int).reshape((-1, 2))
+        h, w = self.image_shape
+        ids = self.point_ids[src][points_rc[:, 0], points_rc[:, 1]]
+        observed = ids >= 0
+        P_W = self.points[:, np.maximum(ids, 0)]
+
+        corrs = np.zeros((len(dsts), len(ids), 2), dtype=int)
+        valid = np.zeros((len(dsts), len(ids)), dtype=bool)
+        for d, dst in enumerate(dsts):
+            P_C = self.T_C_W[dst] * P_W
+            in_front = observed & (P_C[2] > 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                corr = np.flip(project(P_C, self.K), axis=0)
+            corr[:, ~in_front] = -1
+            corr = np.trunc(corr).astype(int).T
+            inside = in_front & (corr[:, 0] >= 0) & (corr[:, 0] < h) & \
+                (corr[:, 1] >= 0) & (corr[:, 1] < w)
+            if occlusion_tol is not None:
+                depth = self.depthImage(dst)[
+                    corr[inside, 0], corr[inside, 1]]
+                inside[inside] = (depth == 0.) | \
+                    (P_C[2, inside] <= depth * (1. + occlusion_tol))
+            corrs[d] = corr
+            valid[d] = inside
+
+        if single:
+            return corrs[0], valid[0]
+        return corrs, valid
+
     def correspondenceExample(self):
         n_pts = 20
-        pts = (np.random.random((n_pts, 2)) * np.array((600, 800))).astype(int)
-        corrs = np.zeros((n_pts, 2), dtype=int)
-        corr_valid = np.ones(n_pts, dtype=bool)
-        for i in range(n_pts):
-            corr = self.getCorrespondence(pts[i], 0, 118)
-            if corr is None:
-                corr_valid[i] = False
-            else:
-                corrs[i] = corr
+        h, w = self.image_shape
+        pts = (np.random.random((n_pts, 2)) * np.array((h, w))).astype(int)
+        corrs, corr_valid = self.getCorrespondences(pts, 0, 118)
         pts = pts[corr_valid, :]
         corrs = corrs[corr_valid, :]
         ims = [cv2.imread(self.images[i]) for i in [0, 118]]
@@ -146,7 +303,67 @@ class SameLightSequence(base.RectifiedMonoSequence):
         assert ims[0].shape[2] == 3
         render = np.concatenate(ims, axis=1)
         for i in range(len(pts)):
-            cv2.line(render, tuple(pts[i, [1, 0]]), tuple(
-                corrs[i, [1, 0]] + np.array([800, 0])), (255, 0, 0), 2,
-                     cv2.LINE_AA)
+            cv2.line(render, tuple(int(j) for j in pts[i, [1, 0]]),
+                     tuple(int(j) for j in corrs[i, [1, 0]] + (w, 0)),
+                     (255, 0, 0), 2, cv2.LINE_AA)
         return render
+
+
+def _observedPointsJob(job):
+    seq_i, half, frame_i, out_file = job
+    calib = Calibration()
+    T_C_W = calib.getT_W_C()[frame_i].inverse()
+    ids = observedPoints(pointCloud(seq_i, mmap=True), T_C_W,
+                         calib.getK(half), imageShape(half))
+    utils_path.saveNpyAtomic(out_file, ids.astype(np.int32))
+    return job
+
+
+def precomputePointIds(seq_is, half=True, num_processes=None):
+    """ Computes the point ids of all frames of the scans seq_is on a process
+    pool. Workers share each point cloud through a memory-mapped .npy (see
+    pointCloud()). Frames are saved as they complete and merged into the
+    PointIds files once a scan is complete, so interrupted runs resume where
+    they stopped. """
+    import multiprocessing
+    import shutil
+
+    jobs = []
+    remaining = {}
+    for seq_i in seq_is:
+        path = os.path.join(_seqPath(seq_i, half), 'point_ids')
+        if PointIds.exists(path):
+            continue
+        frames_dir = path + '_frames'
+        if not os.path.exists(frames_dir):
+            os.makedirs(frames_dir)
+        # Converted here, such that workers only map it.
+        pointCloud(seq_i, mmap=True)
+        frame_files = [os.path.join(frames_dir, '%03d.npy' % i)
+                       for i in range(119)]
+        todo = [i for i in range(119) if not os.path.exists(frame_files[i])]
+        jobs += [(seq_i, half, i, frame_files[i]) for i in todo]
+        remaining[seq_i] = (len(todo), path, frame_files)
+
+    def merge(seq_i):
+        _, path, frame_files = remaining[seq_i]
+        PointIds.write(path, (np.load(i) for i in frame_files))
+        shutil.rmtree(path + '_frames')
+        print('Point ids of scan %d done.' % seq_i)
+
+    for seq_i in [i for i in remaining if remaining[i][0] == 0]:
+        merge(seq_i)
+    if len(jobs) == 0:
+        return
+    print('Computing point ids of %d frames...' % len(jobs))
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        for seq_i, _, _, _ in pool.imap_unordered(_observedPointsJob, jobs):
+            num_left, path, frame_files = remaining[seq_i]
+            remaining[seq_i] = (num_left - 1, path, frame_files)
+            if num_left == 1:
+                merge(seq_i)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -17,15 +17,16 @@
 # You should have received a copy of the GNU General Public License
 # along with imips_open_deps. If not, see <http:#www.gnu.org/licenses/>.
 
+from __future__ import print_function
 import cv2
-import IPython
 import numpy as np
 import os
-import pyquaternion as quat
+import sys
 import yaml
 
 from rpg_common_py import pose
 import rpg_datasets_py.base as base
+import rpg_datasets_py.utils.metadata_cache as metadata_cache
 from rpg_datasets_py.utils.symlink import symlink
 
 
@@ -50,68 +51,184 @@ class Cam(object):
         self.map1 = None
         self.map2 = None
 
-    def setUndistortRectifyMap(self, R, P):
+    def setUndistortRectifyMap(self, R, P, fixed_point=True):
+        """ Fixed-point maps make remap() considerably cheaper, at 1/32
+        pixel interpolation resolution. """
         self.map1, self.map2 = cv2.initUndistortRectifyMap(
             self.K, self.dist, R, P, tuple(self.resolution), cv2.CV_32FC1)
+        if fixed_point:
+            self.map1, self.map2 = cv2.convertMaps(
+                self.map1, self.map2, cv2.CV_16SC2)
 
+    def rectify(self, img):
+        return cv2.remap(img, self.map1, self.map2, cv2.INTER_LINEAR)
 
-class EurocSeq(base.RectifiedStereoSequence):
-    def __init__(self, sequence_id):
-        root = os.path.join(symlink('euroc'), sequence_id, 'mav0')
 
-        lr_images = [None, None]
-        for i in [0, 1]:
-            image_folder = os.path.join(root, 'rect%d' % i)
-            if not os.path.exists(image_folder):
-                raise Exception(
-                    'Need to call euroc.undistort() on this sequence first!')
-            K = np.loadtxt(os.path.join(image_folder, 'K.txt'))
-            image_folder_contents = sorted(os.listdir(image_folder))
-            if i == 0:
-                image_times = [int(j[:-4]) for j in
-                               image_folder_contents if j.endswith('.png')]
-            lr_images[i] = [os.path.join(image_folder, j) for j in
-                            image_folder_contents if j.endswith('.png')]
-        assert len(lr_images[0]) == len(lr_images[1])
-        left_images = lr_images[0]
-        right_images = lr_images[1]
+def _parseSequence(root, image_folders):
+    lr_images = [None, None]
+    for i in [0, 1]:
+        image_folder = image_folders[i]
+        image_folder_contents = sorted(os.listdir(image_folder))
+        if i == 0:
+            image_times = [int(j[:-4]) for j in
+                           image_folder_contents if j.endswith('.png')]
+        lr_images[i] = [os.path.join(image_folder, j) for j in
+                        image_folder_contents if j.endswith('.png')]
 
-        gt_path = os.path.join(root, 'state_groundtruth_estimate0')
-        gt_data_file = os.path.join(gt_path, 'data.csv')
-        gt_data = np.loadtxt(gt_data_file, skiprows=1, delimiter=',')
+    gt_path = os.path.join(root, 'state_groundtruth_estimate0')
+    gt_data_file = os.path.join(gt_path, 'data.csv')
+    gt_data = np.loadtxt(gt_data_file, skiprows=1, delimiter=',')
+
+    gt_trajectory = base.TimedTrajectory(gt_data[:, 0], pose.PoseArray(
+        pose.quaternionsToRotations(gt_data[:, 4:8]), gt_data[:, 1:4]))
+    # Only interestd in poses at image times:
+    T_W_GT = gt_trajectory.nearest(image_times)
+
+    gt_extr_file = os.path.join(gt_path, 'sensor.yaml')
+    yam = yaml.load(file(gt_extr_file, 'r'))
+    T_B_GT_arr = np.array(yam['T_BS']['data']).reshape((4, 4))
+    T_B_GT = pose.fromApproximateMatrix(T_B_GT_arr)
+    T_GT_B = T_B_GT.inverse()
+
+    # TODO: Dataset-dependent?
+    cams = [Cam(root, i) for i in [0, 1]]
+    T_W_C = T_W_GT * (T_GT_B * cams[0].T_B_C)
+
+    baseline = (cams[0].T_B_C.inverse() * cams[1].T_B_C).t[0]
 
-        # Only interestd in poses at image times:
-        vicon_filter = []
-        for image_time in image_times:
-            vicon_filter.append(np.argmin(
-                np.abs(gt_data[:, 0] - image_time)))
-        gt_data = gt_data[vicon_filter, :]
+    return {'left_images': lr_images[0], 'right_images': lr_images[1],
+            'image_times': image_times, 'T_W_C': T_W_C.asArray(),
+            'baseline': baseline}
 
-        T_W_GT = [pose.Pose(
-            quat.Quaternion(row[4:8]).rotation_matrix, row[1:4].reshape((3, 1)))
-            for row in gt_data]
 
-        gt_extr_file = os.path.join(gt_path, 'sensor.yaml')
-        yam = yaml.load(file(gt_extr_file, 'r'))
-        T_B_GT_arr = np.array(yam['T_BS']['data']).reshape((4, 4))
-        T_B_GT = pose.fromApproximateMatrix(T_B_GT_arr)
-        T_GT_B = T_B_GT.inverse()
+def _parseRectifiedSequence(root, rect_folders):
+    meta = _parseSequence(root, rect_folders)
+    meta['K'] = np.loadtxt(os.path.join(rect_folders[1], 'K.txt'))
+    return meta
 
-        # TODO: Dataset-dependent?
-        cams = [Cam(root, i) for i in [0, 1]]
-        T_W_C = [i * T_GT_B * cams[0].T_B_C for i in T_W_GT]
 
-        baseline = (cams[0].T_B_C.inverse() * cams[1].T_B_C).t[0]
+class ImuStream(object):
+    """ IMU samples of a EuRoC sequence. data.csv is converted once to
+    binary arrays, which are then memory-mapped. times are in ns, gyro
+    (w_RS_S) in rad/s and acc (a_RS_S) in m/s^2. """
+    def __init__(self, root):
+        csv_file = os.path.join(root, 'imu0', 'data.csv')
+        arrays = metadata_cache.cachedMemmap(
+            'euroc_imu', [csv_file], lambda: _parseImu(csv_file))
+        self.times = arrays['times']
+        self.gyro = arrays['data'][:, :3]
+        self.acc = arrays['data'][:, 3:]
+
+    def __len__(self):
+        return len(self.times)
+
+    def indicesBetween(self, t_start, t_end):
+        """ Range of samples with t_start <= time <= t_end. """
+        start = np.searchsorted(self.times, t_start, side='left')
+        end = np.searchsorted(self.times, t_end, side='right')
+        return start, end
+
+    def between(self, t_start, t_end):
+        """ Returns times, gyro, acc as views into the memory map. """
+        start, end = self.indicesBetween(t_start, t_end)
+        return (self.times[start:end], self.gyro[start:end],
+                self.acc[start:end])
+
+
+def _parseImu(csv_file):
+    # Single pass; the nanosecond timestamps are parsed as exact integers.
+    rows = np.loadtxt(csv_file, delimiter=',', skiprows=1, ndmin=1,
+                      dtype=[('times', np.int64), ('data', np.float64, (6,))])
+    return {'times': rows['times'], 'data': rows['data']}
+
+
+# Rectification maps per sequence root, see EurocSeq(rectify_on_access=True).
+_rectifications = {}
+
+
+class EurocSeq(base.RectifiedStereoSequence):
+    def __init__(self, sequence_id, rectify_on_access=False, cache_bytes=0):
+        """ By default, images are read from rect0/rect1 as written by
+        undistort(). With rectify_on_access, the raw images in cam0/cam1 are
+        used instead and rectified with the same maps when accessed; then,
+        __getitem__ returns decoded images rather than (unrectified) paths,
+        and cache_bytes bounds the decoded image cache. """
+        root = os.path.join(symlink('euroc'), sequence_id, 'mav0')
 
-        print(image_folder)
+        if rectify_on_access:
+            image_folders = [os.path.join(root, 'cam%d' % i, 'data')
+                             for i in [0, 1]]
+            if root not in _rectifications:
+                _rectifications[root] = stereoRectification(root)
+            self._cams, K = _rectifications[root]
+            sources = list(image_folders)
+            parse = lambda: _parseSequence(root, image_folders)
+            cache_name = 'euroc_raw_%s' % sequence_id
+        else:
+            image_folders = [os.path.join(root, 'rect%d' % i) for i in [0, 1]]
+            for image_folder in image_folders:
+                if not os.path.exists(image_folder):
+                    raise Exception('Need to call euroc.undistort() on this '
+                                    'sequence first, or use '
+                                    'rectify_on_access!')
+            self._cams = None
+            sources = image_folders + \
+                [os.path.join(i, 'K.txt') for i in image_folders]
+            parse = lambda: _parseRectifiedSequence(root, image_folders)
+            cache_name = 'euroc_%s' % sequence_id
+        gt_path = os.path.join(root, 'state_groundtruth_estimate0')
+        sources += \
+            [os.path.join(gt_path, i) for i in ['data.csv', 'sensor.yaml']] + \
+            [os.path.join(root, 'cam%d' % i, 'sensor.yaml') for i in [0, 1]]
+        meta = metadata_cache.cached(cache_name, sources, parse)
+
+        left_images = meta['left_images'].tolist()
+        right_images = meta['right_images'].tolist()
+        assert len(left_images) == len(right_images)
+        self.image_times = meta['image_times'].astype(np.int64)
+        self._root = root
+        self._imu = None
+        if not rectify_on_access:
+            K = meta['K']
+        T_W_C = pose.fromMatrices(meta['T_W_C'])
+        baseline = meta['baseline']
+
+        print(image_folders[1])
         base.RectifiedStereoSequence.__init__(
             self, left_images, right_images, K, K, T_W_C, baseline, 'euroc',
             sequence_id)
+        if rectify_on_access:
+            self.setDecoding(cache_bytes=cache_bytes)
 
+    def imu(self):
+        """ ImuStream of this sequence, loaded on first use. """
+        if self._imu is None:
+            self._imu = ImuStream(self._root)
+        return self._imu
+
+    def imuBetweenFrames(self, i, j):
+        """ IMU times, gyro and acc from the time of frame i up to the time
+        of frame j, as zero-copy views. """
+        return self.imu().between(self.image_times[i], self.image_times[j])
+
+    def _decodeImage(self, i, right):
+        if self._cams is None:
+            return base.RectifiedStereoSequence._decodeImage(self, i, right)
+        path = self.right_images[i] if right else self.images[i]
+        # Same as undistort():
+        img = cv2.imread(path)
+        if img is None:
+            raise IOError('Could not read image %s!' % path)
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        img = self._cams[1 if right else 0].rectify(img)
+        if self._imread_flags == cv2.IMREAD_COLOR:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        return img
 
-def undistort(sequence_id):
-    root = os.path.join(symlink('euroc'), sequence_id, 'mav0')
 
+def stereoRectification(root, fixed_point=True):
+    """ Returns both cams with rectification maps set, and the rectified
+    K. """
     cams = [Cam(root, i) for i in [0, 1]]
     assert np.all(cams[0].resolution == cams[1].resolution)
 
@@ -121,31 +238,107 @@ def undistort(sequence_id):
         cams[0].K, cams[0].dist, cams[1].K, cams[1].dist,
         tuple(cams[0].resolution), T_C1_C0.R, T_C1_C0.t, alpha=0)
 
-    cams[0].setUndistortRectifyMap(R1, P1)
-    cams[1].setUndistortRectifyMap(R2, P2)
+    cams[0].setUndistortRectifyMap(R1, P1, fixed_point=fixed_point)
+    cams[1].setUndistortRectifyMap(R2, P2, fixed_point=fixed_point)
 
     new_K = [P1[:3, :3], P2[:3, :3]]
 
     assert np.all(new_K[0] == new_K[1])
+    return cams, new_K[0]
 
-    for i in [0, 1]:
-        image_folder = os.path.join(root, 'cam%d' % i, 'data')
-        out_folder = os.path.join(root, 'rect%d' % i)
-        if not os.path.exists(out_folder):
-            os.makedirs(out_folder)
 
-        np.savetxt(os.path.join(out_folder, 'K.txt'), new_K[i])
+# Map type written by undistort(), see stereoRectification().
+_MAP_TYPE = 'CV_16SC2'
 
-        image_folder_contents = sorted(os.listdir(image_folder))
-        in_images = [os.path.join(image_folder, j) for j in
-                     image_folder_contents if j.endswith('.png')]
-        out_images = [os.path.join(out_folder, j) for j in
-                      image_folder_contents if j.endswith('.png')]
-
-        for j in range(len(in_images)):
-            print('%d/%d' % (j, len(in_images)))
-            img = cv2.imread(in_images[j])
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            undimg = cv2.remap(
-                img, cams[i].map1, cams[i].map2, cv2.INTER_LINEAR)
-            cv2.imwrite(out_images[j], undimg)
+
+def _readMapType(map_file):
+    if not os.path.exists(map_file):
+        return None
+    with open(map_file) as f:
+        return f.read().strip()
+
+
+class _UndistortJob(object):
+    def __init__(self, cam, force):
+        self._cam = cam
+        self._force = force
+
+    def __call__(self, in_out):
+        """ Returns whether the image had to be undistorted. """
+        in_image, out_image = in_out
+        if not self._force and os.path.exists(out_image) and \
+                os.path.getmtime(out_image) >= os.path.getmtime(in_image):
+            return False
+        img = cv2.imread(in_image)
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        undimg = self._cam.rectify(img)
+        # Written under a temporary name, so an interrupted run never leaves
+        # a partial image that looks up to date.
+        tmp_image = out_image + '.tmp'
+        with open(tmp_image, 'wb') as f:
+            f.write(cv2.imencode('.png', undimg)[1].tobytes())
+        os.rename(tmp_image, out_image)
+        return True
+
+
+def undistort(sequence_id, num_threads=None):
+    """ Resumable: images whose output is newer than the input are skipped,
+    unless the rectification has changed. Runs on num_threads threads
+    (default: one per core), since cv2 releases the GIL. """
+    import multiprocessing
+    import multiprocessing.pool
+    import time
+
+    root = os.path.join(symlink('euroc'), sequence_id, 'mav0')
+    cams, new_K = stereoRectification(root)
+    if num_threads is None:
+        num_threads = multiprocessing.cpu_count()
+    pool = multiprocessing.pool.ThreadPool(num_threads)
+
+    try:
+        for i in [0, 1]:
+            image_folder = os.path.join(root, 'cam%d' % i, 'data')
+            out_folder = os.path.join(root, 'rect%d' % i)
+            if not os.path.exists(out_folder):
+                os.makedirs(out_folder)
+
+            # Outputs are only reused if they were made with the same K and
+            # the same (fixed-point) maps. Both files are written once the
+            # folder is complete, so an interrupted run is forced again.
+            K_file = os.path.join(out_folder, 'K.txt')
+            map_file = os.path.join(out_folder, 'map_type.txt')
+            force = not os.path.exists(K_file) or \
+                not np.array_equal(np.loadtxt(K_file), new_K) or \
+                _readMapType(map_file) != _MAP_TYPE
+            if force:
+                for stale_file in [K_file, map_file]:
+                    if os.path.exists(stale_file):
+                        os.remove(stale_file)
+
+            image_folder_contents = sorted(os.listdir(image_folder))
+            in_images = [os.path.join(image_folder, j) for j in
+                         image_folder_contents if j.endswith('.png')]
+            out_images = [os.path.join(out_folder, j) for j in
+                          image_folder_contents if j.endswith('.png')]
+
+            start = time.time()
+            done = 0
+            converted = 0
+            for was_converted in pool.imap_unordered(
+                    _UndistortJob(cams[i], force),
+                    zip(in_images, out_images), chunksize=16):
+                done += 1
+                converted += was_converted
+                if done % 100 == 0 or done == len(in_images):
+                    print('\rrect%d: %d/%d, %d undistorted, %.1f images/s' % (
+                        i, done, len(in_images), converted,
+                        done / max(time.time() - start, 1e-6)), end='')
+                    sys.stdout.flush()
+            print('')
+            if force:
+                np.savetxt(K_file, new_K)
+                with open(map_file, 'w') as f:
+                    f.write(_MAP_TYPE + '\n')
+    finally:
+        pool.terminate()
+        pool.join()
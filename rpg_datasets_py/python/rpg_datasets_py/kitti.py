@@ -22,28 +22,42 @@ import os
 
 from rpg_common_py import pose
 import rpg_datasets_py.base as base
+import rpg_datasets_py.utils.metadata_cache as metadata_cache
 from rpg_datasets_py.utils.symlink import symlink
 import rpg_datasets_py.utils.path as utils_path
 
 
+def _parseSequence(seq_folder, poses_file, calib_file):
+    images, right_images = utils_path.imagesFromSubdirs(
+        seq_folder, sub_names=['image_0', 'image_1'], extension='.png')
+    return {'images': images, 'right_images': right_images,
+            'poses': np.loadtxt(poses_file),
+            'calibs': np.loadtxt(calib_file, usecols=range(1, 13))}
+
+
 class KittiSeq(base.RectifiedStereoSequence):
     def __init__(self, sequence_id):
         seq_folder = os.path.join(symlink('kitti'), sequence_id)
-        images, right_images = utils_path.imagesFromSubdirs(
-            seq_folder, sub_names=['image_0', 'image_1'], extension='.png')
+        poses_file = os.path.join(
+            symlink('kitti'), 'poses', sequence_id + '.txt')
+        calib_file = os.path.join(seq_folder, 'calib.txt')
+        sources = [os.path.join(seq_folder, 'image_0'),
+                   os.path.join(seq_folder, 'image_1'), poses_file, calib_file]
+        meta = metadata_cache.cached(
+            'kitti_%s' % sequence_id, sources,
+            lambda: _parseSequence(seq_folder, poses_file, calib_file))
+
+        images = meta['images'].tolist()
+        right_images = meta['right_images'].tolist()
         assert len(images) == len(right_images)
         assert len(images) > 0
 
-        poses = np.loadtxt(os.path.join(
-            symlink('kitti'), 'poses', sequence_id + '.txt'))
+        poses = meta['poses']
         assert poses.shape[0] == len(images)
 
-        T_W_C = [pose.fromMatrix(np.reshape(
-            poses[i, :], (3, 4))) for i in
-            range(poses.shape[0])]
+        T_W_C = pose.fromMatrices(np.reshape(poses, (-1, 3, 4)))
 
-        calibs = np.loadtxt(os.path.join(seq_folder, 'calib.txt'),
-                            usecols=range(1, 13))
+        calibs = meta['calibs']
         assert len(calibs) == 4
 
         left_K = np.reshape(calibs[0], [3, 4])[:3, :3]
@@ -66,3 +80,9 @@ def split(tvt):
     else:
         assert tvt == 'testing'
         return ['00']
+
+
+def splitSequence(tvt, num_threads=None):
+    """ All sequences of a split as one base.ConcatSequence, constructed in
+    parallel. """
+    return base.ConcatSequence.build(KittiSeq, split(tvt), num_threads)
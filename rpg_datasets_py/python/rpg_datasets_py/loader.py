@@ -0,0 +1,111 @@
+# Copyright (C) 2019 Titus Cieslewski, RPG, University of Zurich, Switzerland
+#   You can contact the author at <titus at ifi dot uzh dot ch>
+# Copyright (C) 2019 Davide Scaramuzza, RPG, University of Zurich, Switzerland
+#
+# This file is part of imips_open_deps.
+#
+# imips_open_deps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# imips_open_deps is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with imips_open_deps. If not, see <http:#www.gnu.org/licenses/>.
+
+import collections
+import itertools
+import multiprocessing.pool
+import numpy as np
+
+
+def sequentialIndices(sequence):
+    return iter(range(len(sequence)))
+
+
+def shuffledIndices(sequence, epochs=1, seed=None):
+    rng = np.random.RandomState(seed)
+    for _ in range(epochs):
+        for i in rng.permutation(len(sequence)):
+            yield i
+
+
+def pairIndices(sequence, max_gap, num_pairs=None, seed=None):
+    """ Random pairs of distinct frames that are at most max_gap apart;
+    infinite if num_pairs is None. The gap is uniform in [1, max_gap], and
+    the first frame uniform among those that admit it. """
+    rng = np.random.RandomState(seed)
+    n = len(sequence)
+    assert 0 < max_gap < n
+    for _ in (itertools.count() if num_pairs is None else range(num_pairs)):
+        gap = rng.randint(1, max_gap + 1)
+        i = rng.randint(n - gap)
+        yield (i, i + gap)
+
+
+class PrefetchLoader(object):
+    """ Iterates over batches of (image, pose, K) for a stream of frame
+    indices, decoding frames ahead of time on a pool of threads (cv2 releases
+    the GIL while decoding). Items of the index stream can also be tuples of
+    indices, e.g. from pairIndices(), in which case each batch element is the
+    corresponding tuple of (image, pose, K). At most depth batches are
+    decoded ahead of the consumer, which bounds memory use. pose and K are
+    None for sequences without them. """
+    def __init__(self, sequence, indices, batch_size=1, num_workers=8,
+                 depth=4, right=False):
+        assert batch_size > 0 and depth > 0
+        self._sequence = sequence
+        self._indices = iter(indices)
+        self._batch_size = batch_size
+        self._num_workers = num_workers
+        self._depth = depth
+        self._right = right
+
+    def _frame(self, i):
+        seq = self._sequence
+        if self._right:
+            image = seq.rightImage(i)
+            K = seq.right_K
+        else:
+            image = seq.image(i)
+            K = getattr(seq, 'K', None)
+        T_W_C = getattr(seq, 'T_W_C', None)
+        return image, None if T_W_C is None else T_W_C[i], K
+
+    def _submitBatch(self, pool):
+        items = list(itertools.islice(self._indices, self._batch_size))
+        if len(items) == 0:
+            return None
+        batch = []
+        for item in items:
+            if isinstance(item, tuple):
+                batch.append(tuple(pool.apply_async(self._frame, (i,))
+                                   for i in item))
+            else:
+                batch.append(pool.apply_async(self._frame, (item,)))
+        return batch
+
+    def __iter__(self):
+        pool = multiprocessing.pool.ThreadPool(self._num_workers)
+        try:
+            pending = collections.deque()
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < self._depth:
+                    batch = self._submitBatch(pool)
+                    if batch is None:
+                        exhausted = True
+                    else:
+                        pending.append(batch)
+                if len(pending) == 0:
+                    break
+                batch = pending.popleft()
+                yield [tuple(j.get() for j in i) if isinstance(i, tuple)
+                       else i.get() for i in batch]
+        finally:
+            pool.terminate()
+            pool.join()
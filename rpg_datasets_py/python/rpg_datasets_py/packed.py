@@ -0,0 +1,112 @@
+# Copyright (C) 2019 Titus Cieslewski, RPG, University of Zurich, Switzerland
+#   You can contact the author at <titus at ifi dot uzh dot ch>
+# Copyright (C) 2019 Davide Scaramuzza, RPG, University of Zurich, Switzerland
+#
+# This file is part of imips_open_deps.
+#
+# imips_open_deps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# imips_open_deps is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with imips_open_deps. If not, see <http:#www.gnu.org/licenses/>.
+
+# Sequences packed into a single raw uint8 array of shape
+# (num_cams, N, H, W[, C]), saved as .npy such that it can be memory-mapped,
+# plus a sidecar with poses, intrinsics, baseline and frame names. Frames are
+# returned as zero-copy views into the memory map, so processes reading the
+# same sequence share the page cache and nothing needs to be decoded.
+
+import numpy as np
+import os
+
+from rpg_common_py import pose
+import rpg_datasets_py.base as base
+
+_IMAGES_FILE = 'images.npy'
+_META_FILE = 'meta.npz'
+
+
+def isPacked(folder):
+    return os.path.exists(os.path.join(folder, _META_FILE))
+
+
+def sequenceMeta(sequence):
+    """ Everything but the images of a sequence as a dict of arrays. """
+    meta = {'set_name': sequence.set_name, 'seq_name': sequence.seq_name,
+            'names': [os.path.basename(str(i)) for i in sequence.images]}
+    if isinstance(sequence, base.RectifiedMonoSequence):
+        meta['K'] = sequence.K
+        meta['T_W_C'] = sequence.poseArray().asArray()
+    if isinstance(sequence, base.RectifiedStereoSequence):
+        meta['right_K'] = sequence.right_K
+        meta['baseline'] = sequence.baseline
+    return dict((key, np.asarray(value)) for key, value in meta.items())
+
+
+def pack(sequence, out_folder):
+    """ Frames are obtained with sequence.image() (and rightImage() for
+    stereo sequences), so use sequence.setDecoding(False, color=True) first
+    to pack color images. """
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+    meta_file = os.path.join(out_folder, _META_FILE)
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+
+    stereo = isinstance(sequence, base.RectifiedStereoSequence)
+    getters = [sequence.image, sequence.rightImage] if stereo \
+        else [sequence.image]
+    first = getters[0](0)
+    assert first.dtype == np.uint8
+    images = np.lib.format.open_memmap(
+        os.path.join(out_folder, _IMAGES_FILE), mode='w+', dtype=np.uint8,
+        shape=(len(getters), len(sequence)) + first.shape)
+    for cam_i, getter in enumerate(getters):
+        for i in range(len(sequence)):
+            images[cam_i, i] = getter(i)
+    images.flush()
+    del images
+
+    # Written last, so an interrupted pack is not mistaken for a complete one.
+    np.savez(meta_file, **sequenceMeta(sequence))
+
+
+class PackedSequence(base.RectifiedStereoSequence):
+    """ Any sequence written with pack(). For mono sequences, right_images,
+    right_K and baseline are None; for plain image sequences, also K and
+    T_W_C. __getitem__ returns frames as read-only np.memmap views. """
+    def __init__(self, folder):
+        if not isPacked(folder):
+            raise Exception('%s has not been written with packed.pack()!' %
+                            folder)
+        meta = np.load(os.path.join(folder, _META_FILE))
+        images = np.load(os.path.join(folder, _IMAGES_FILE), mmap_mode='r')
+        right_images = images[1] if images.shape[0] > 1 else None
+
+        def optional(key):
+            return meta[key] if key in meta.files else None
+
+        T_W_C = optional('T_W_C')
+        if T_W_C is not None:
+            T_W_C = pose.fromMatrices(T_W_C)
+        baseline = optional('baseline')
+        base.RectifiedStereoSequence.__init__(
+            self, images[0], right_images, optional('K'),
+            optional('right_K'), T_W_C,
+            None if baseline is None else float(baseline),
+            str(meta['set_name']), str(meta['seq_name']))
+        self.names = [str(i) for i in meta['names']]
+        self.folder = folder
+
+    def image(self, i):
+        return self.images[i]
+
+    def rightImage(self, i):
+        return self.right_images[i]
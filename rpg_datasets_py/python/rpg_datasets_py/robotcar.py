@@ -20,24 +20,48 @@
 # Robotcar is a special one because it needs tons of preprocessing.
 # For that, code credit also goes to Amadeus Oertel.
 
-import copy
+# Only what CroppedGraySequence needs is imported here. Preprocessing
+# dependencies (the RobotCar SDK, multiprocessing) are imported when
+# preprocessing is called, such that importing this module stays cheap.
+
+from __future__ import print_function
 import cv2
-import itertools
-import matplotlib.pyplot as plt
-import multiprocessing
+import importlib
 import numpy as np
 import os
-import PIL
-import scipy.spatial.distance as scidist
-import skimage.measure
 import sys
+import threading
 
 from rpg_common_py import pose
 import rpg_datasets_py.base as base
+import rpg_datasets_py.utils.metadata_cache as metadata_cache
 from rpg_datasets_py.utils.symlink import symlink
 import rpg_datasets_py.utils.path as utils_path
 
 
+def _loadT_W_C(T_W_C_file):
+    if T_W_C_file.endswith('.npy'):
+        return np.load(T_W_C_file)
+    # Legacy text format, one flattened 4x4 matrix per line.
+    return np.reshape(np.loadtxt(T_W_C_file), (-1, 4, 4))
+
+
+def _T_W_C_file(seq_folder):
+    """ Binary T_W_C.npy if present, else legacy T_W_C.txt. """
+    npy_file = os.path.join(seq_folder, 'T_W_C.npy')
+    if os.path.exists(npy_file):
+        return npy_file
+    return os.path.join(seq_folder, 'T_W_C.txt')
+
+
+def _parseCroppedGraySequence(ims_dir, k_files, T_W_C_file):
+    left_ims, right_ims = utils_path.imagesFromSubdirs(
+        ims_dir, extension='.png')
+    return {'left_ims': left_ims, 'right_ims': right_ims,
+            'Ks': [np.loadtxt(k_file) for k_file in k_files],
+            'T_W_C': _loadT_W_C(T_W_C_file)}
+
+
 class CroppedGraySequence(base.RectifiedStereoSequence):
     def __init__(self, seq_id):
         seq_folder = os.path.join(symlink('robotcar_cropped_gray'), seq_id)
@@ -46,60 +70,138 @@ class CroppedGraySequence(base.RectifiedStereoSequence):
                             'preprocess the raw data!' % seq_id)
 
         ims_dir = os.path.join(seq_folder, 'rect')
-        left_ims, right_ims = utils_path.imagesFromSubdirs(
-            ims_dir, extension='.png')
+        k_files = [os.path.join(seq_folder, '%s_K.txt' % i)
+                   for i in ['left', 'right']]
+        T_W_C_file = _T_W_C_file(seq_folder)
+        sources = [os.path.join(ims_dir, 'left'),
+                   os.path.join(ims_dir, 'right')] + k_files + [T_W_C_file]
+        meta = metadata_cache.cached(
+            'robotcar_%s' % seq_id, sources,
+            lambda: _parseCroppedGraySequence(ims_dir, k_files, T_W_C_file))
+
+        left_ims = meta['left_ims'].tolist()
+        right_ims = meta['right_ims'].tolist()
         assert len(left_ims) == len(right_ims)
         assert len(left_ims) > 0
 
-        k_files = [os.path.join(seq_folder, '%s_K.txt' % i)
-                   for i in ['left', 'right']]
-        Ks = [np.loadtxt(k_file) for k_file in k_files]
+        Ks = meta['Ks']
 
-        T_W_C_file = os.path.join(seq_folder, 'T_W_C.txt')
-        T_W_C_serialized = np.loadtxt(T_W_C_file)
-        T_W_C = [pose.fromMatrix(np.reshape(T_W_C_serialized[i, :], (4, 4)))
-                 for i in range(T_W_C_serialized.shape[0])]
+        T_W_C = pose.fromMatrices(np.reshape(meta['T_W_C'], (-1, 4, 4)))
 
         base.RectifiedStereoSequence.__init__(
             self, left_ims, right_ims, Ks[0], Ks[1], T_W_C, 0.24,
             'rc', seq_id)
 
 
-# Load extra modules.
 sdk_dir = os.path.join(symlink('robotcar'), 'robotcar-dataset-sdk')
 sdk_py_dir = os.path.join(sdk_dir, 'python')
 cam_model_dir = os.path.join(sdk_dir, 'models')
-sys.path.append(sdk_py_dir)
-assert os.path.exists(sdk_py_dir)
-import camera_model
-import image
-import interpolate_poses
-import transform
+
+
+def sdk(module_name):
+    """ Imports a module of the RobotCar SDK on first use. """
+    if sdk_py_dir not in sys.path:
+        if not os.path.exists(sdk_py_dir):
+            raise Exception('RobotCar SDK not found at %s!' % sdk_py_dir)
+        sys.path.append(sdk_py_dir)
+    return importlib.import_module(module_name)
+
+
+def insTrajectory(ins_path):
+    """ INS poses as TimedTrajectory, built the same way as in the SDK's
+    interpolate_poses.interpolate_ins_poses(), but for all rows at once. """
+    # timestamp, northing, easting, down, roll, pitch, yaw
+    ins = np.loadtxt(ins_path, delimiter=',', skiprows=1,
+                     usecols=(0, 5, 6, 7, 12, 13, 14))
+    cr, cp, cy = [np.cos(ins[:, i]) for i in [4, 5, 6]]
+    sr, sp, sy = [np.sin(ins[:, i]) for i in [4, 5, 6]]
+    # R = R_z(yaw) * R_y(pitch) * R_x(roll), see transform.euler_to_so3().
+    R = np.empty((ins.shape[0], 3, 3))
+    R[:, 0, 0] = cy * cp
+    R[:, 0, 1] = cy * sp * sr - sy * cr
+    R[:, 0, 2] = cy * sp * cr + sy * sr
+    R[:, 1, 0] = sy * cp
+    R[:, 1, 1] = sy * sp * sr + cy * cr
+    R[:, 1, 2] = sy * sp * cr - cy * sr
+    R[:, 2, 0] = -sp
+    R[:, 2, 1] = cp * sr
+    R[:, 2, 2] = cp * cr
+    return base.TimedTrajectory(
+        ins[:, 0].astype(np.int64), pose.PoseArray(R, ins[:, 1:4]))
+
+
+def downsample2x2(img):
+    """ 2x2 area downsampling in integer arithmetic. Gives the same result
+    as skimage.measure.block_reduce(img, (2, 2), np.mean).astype('uint8'),
+    including the zero padding of odd dimensions. """
+    h, w = img.shape
+    padded = np.zeros((h + h % 2, w + w % 2), dtype=np.uint16)
+    padded[:h, :w] = img
+    sums = padded[0::2, 0::2] + padded[1::2, 0::2] + \
+        padded[0::2, 1::2] + padded[1::2, 1::2]
+    return (sums >> 2).astype(np.uint8)
+
+
+def croppedGray(img):
+    """ Crops the car hood away, converts to gray and halves resolution. """
+    img = img[:820, :, :]
+    img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    return downsample2x2(img)
+
+
+def croppedK(cam_model):
+    # Image downscaling affects camera intrinsics
+    f = [0.5 * x for x in cam_model.focal_length]
+    c = [0.5 * x for x in cam_model.principal_point]
+    return np.array([[f[0], 0, c[0]],
+                     [0, f[1], c[1]],
+                     [0, 0, 1]])
 
 
 class ParallelImageConverter(object):
-    def __init__(self, model, in_dir, out_dir, images):
-        self._model = model
-        self._in_dir = in_dir
-        self._out_dir = out_dir
-        self._images = images
-
-    def __call__(self, i):
-        out = os.path.join(self._out_dir, self._images[i])
-        if os.path.exists(out):
-            return
-        in_image = os.path.join(self._in_dir, self._images[i])
-        img = image.load_image(in_image, self._model)
-        img = img[:820, :, :]
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-        img = skimage.measure.block_reduce(
-            img, block_size=(2, 2), func=np.mean).astype('uint8')
-        im = PIL.Image.fromarray(img)
-        im.save(out)
-        print(i)
-
-
-def makeCroppedGraySequence(seq_id, num_threads=8):
+    def __init__(self, models, in_dirs, out_dirs):
+        """ All arguments are dicts indexed by 'left' / 'right'. """
+        self._models = models
+        self._in_dirs = in_dirs
+        self._out_dirs = out_dirs
+
+    def __call__(self, leftright_name):
+        leftright, name = leftright_name
+        in_image = os.path.join(self._in_dirs[leftright], name)
+        img = sdk('image').load_image(in_image, self._models[leftright])
+        img = croppedGray(img)
+        out = os.path.join(self._out_dirs[leftright], name)
+        # Written under a temporary name, such that an interrupted conversion
+        # never leaves a partial image that would be skipped on resume.
+        with open(out + '.tmp', 'wb') as f:
+            f.write(cv2.imencode('.png', img)[1].tobytes())
+        os.rename(out + '.tmp', out)
+
+
+# Set in each worker process by _initConverter().
+_converter = None
+
+
+def _initConverter(in_dirs, out_dirs):
+    """ Pool initializer: the camera models carry large lookup tables, so
+    they are built once per worker rather than pickled with the tasks. """
+    global _converter
+    camera_model = sdk('camera_model')
+    models = dict((i, camera_model.CameraModel(cam_model_dir, in_dirs[i]))
+                  for i in in_dirs)
+    _converter = ParallelImageConverter(models, in_dirs, out_dirs)
+
+
+def _convertImage(leftright_name):
+    _converter(leftright_name)
+
+
+def makeCroppedGraySequence(seq_id, num_threads=8, chunksize=None):
+    """ Images that have already been converted are skipped. """
+    import multiprocessing
+    import time
+    camera_model = sdk('camera_model')
+
     src_folder = os.path.join(symlink('robotcar'), seq_id)
     dst_folder = os.path.join(symlink('robotcar_cropped_gray'), seq_id)
     if not os.path.exists(dst_folder):
@@ -108,6 +210,9 @@ def makeCroppedGraySequence(seq_id, num_threads=8):
     # Convert images.
     stereo_dir = os.path.join(src_folder, 'stereo')
 
+    in_dirs, out_dirs = {}, {}
+    tasks = []
+    num_images = 0
     for leftright in ['left', 'right']:
         in_dir = os.path.join(stereo_dir, leftright)
         images = utils_path.imagesFromDir(in_dir, extension='.png')
@@ -116,44 +221,180 @@ def makeCroppedGraySequence(seq_id, num_threads=8):
         out_dir = os.path.join(dst_folder, 'rect', leftright)
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
-
-        p = multiprocessing.Pool(num_threads)
-        print('Converting %s...' % leftright)
-        p.map(ParallelImageConverter(
-            cam_model, in_dir, out_dir, im_names), range(len(images)))
+        done = set(os.listdir(out_dir))
+        tasks += [(leftright, i) for i in im_names if i not in done]
+        num_images += len(im_names)
+        in_dirs[leftright] = in_dir
+        out_dirs[leftright] = out_dir
 
         # K files
-        # Image downscaling affects camera intrinsics
-        f = [0.5 * x for x in cam_model.focal_length]
-        c = [0.5 * x for x in cam_model.principal_point]
-        K = np.array([[f[0], 0, c[0]],
-                      [0, f[1], c[1]],
-                      [0, 0, 1]])
-        np.savetxt(os.path.join(dst_folder, '%s_K.txt' % leftright), K)
+        np.savetxt(os.path.join(dst_folder, '%s_K.txt' % leftright),
+                   croppedK(cam_model))
+
+    print('Converting %d images, %d already converted...' % (
+        len(tasks), num_images - len(tasks)))
+    if len(tasks) > 0:
+        if chunksize is None:
+            chunksize = max(1, min(64, len(tasks) // (4 * num_threads)))
+        pool = multiprocessing.Pool(
+            num_threads, initializer=_initConverter,
+            initargs=(in_dirs, out_dirs))
+        start = time.time()
+        try:
+            for i, _ in enumerate(pool.imap_unordered(
+                    _convertImage, tasks, chunksize=chunksize)):
+                if (i + 1) % 500 == 0 or i + 1 == len(tasks):
+                    print('\r%d/%d, %.1f images/s' % (
+                        i + 1, len(tasks), (i + 1) / (time.time() - start)),
+                        end='')
+                    sys.stdout.flush()
+            print('')
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
     times = [int(i[:16]) for i in im_names]
 
     # Get poses everywhere.
-    T_W_C_file = os.path.join(dst_folder, 'T_W_C.txt')
-    if not os.path.exists(T_W_C_file):
-        print('Interpolating poses...')
-        insext = np.loadtxt(os.path.join(
-            sdk_dir, 'extrinsics', 'ins.txt')).tolist()
-        mtx = transform.build_se3_transform(insext)
-        # Cx: Oxford style camera, where x looks into the image plane.
-        T_I_Cx = pose.fromMatrix(np.asarray(mtx)).inverse()
-        T_Cx_C = pose.yRotationDeg(90) * pose.zRotationDeg(90)
-        T_I_C = T_I_Cx * T_Cx_C
-
-        # T_W_I0: Because in Oxford, z looks down.
-        T_W_I0 = pose.xRotationDeg(180)
-
-        ins_path = os.path.join(src_folder, 'gps', 'ins.csv')
-        T_I0_I = interpolate_poses.interpolate_ins_poses(
-            ins_path, times, times[0])
-
-        T_I0_I = [pose.fromMatrix(np.asarray(i)) for i in T_I0_I]
-
-        T_W_C = [T_W_I0 * i * T_I_C for i in T_I0_I]
-        T_W_C_serialized = np.array([i.asArray().ravel() for i in T_W_C])
-        np.savetxt(T_W_C_file, T_W_C_serialized)
+    if not os.path.exists(_T_W_C_file(dst_folder)):
+        makeCroppedGrayPoses(seq_id, times)
+
+
+def makeCroppedGrayPoses(seq_id, times=None):
+    """ (Re)computes T_W_C.npy of a cropped gray sequence without touching
+    its images, for the given image times (in us), or by default the times
+    of the converted left images. """
+    src_folder = os.path.join(symlink('robotcar'), seq_id)
+    dst_folder = os.path.join(symlink('robotcar_cropped_gray'), seq_id)
+    if times is None:
+        left_ims = utils_path.imagesFromDir(
+            os.path.join(dst_folder, 'rect', 'left'), extension='.png')
+        times = [int(os.path.basename(i)[:16]) for i in left_ims]
+    print('Interpolating poses...')
+    T_W_C = interpolateT_W_C(src_folder, times)
+    np.save(os.path.join(dst_folder, 'T_W_C.npy'), T_W_C.asArray())
+
+
+def interpolateT_W_C(src_folder, times):
+    """ Left camera poses (PoseArray) at the given image times, relative to
+    the INS pose at the first time. """
+    transform = sdk('transform')
+    insext = np.loadtxt(os.path.join(
+        sdk_dir, 'extrinsics', 'ins.txt')).tolist()
+    mtx = transform.build_se3_transform(insext)
+    # Cx: Oxford style camera, where x looks into the image plane.
+    T_I_Cx = pose.fromMatrix(np.asarray(mtx)).inverse()
+    T_Cx_C = pose.yRotationDeg(90) * pose.zRotationDeg(90)
+    T_I_C = T_I_Cx * T_Cx_C
+
+    # T_W_I0: Because in Oxford, z looks down.
+    T_W_I0 = pose.xRotationDeg(180)
+
+    ins_path = os.path.join(src_folder, 'gps', 'ins.csv')
+    T_Ins_I = insTrajectory(ins_path).interpolate(times)
+    T_I0_I = T_Ins_I[0].inverse() * T_Ins_I
+
+    return T_W_I0 * T_I0_I * T_I_C
+
+
+def _parseRawSequence(src_folder):
+    left_ims, right_ims = utils_path.imagesFromSubdirs(
+        os.path.join(src_folder, 'stereo'), extension='.png')
+    times = [int(os.path.basename(i)[:16]) for i in left_ims]
+    T_W_C = interpolateT_W_C(src_folder, times)
+    return {'left_ims': left_ims, 'right_ims': right_ims,
+            'T_W_C': T_W_C.asArray()}
+
+
+class RawCroppedGraySequence(base.RectifiedStereoSequence):
+    """ Same frames, K and T_W_C as CroppedGraySequence, but computed from the
+    raw Bayer images when accessed, without makeCroppedGraySequence().
+    __getitem__ returns decoded images; they are kept in an LRU cache of
+    cache_bytes, and the next readahead frames after each access are
+    decoded in the background on num_threads threads. """
+    def __init__(self, seq_id, cache_bytes=256 * 2 ** 20, readahead=8,
+                 num_threads=4):
+        camera_model = sdk('camera_model')
+        src_folder = os.path.join(symlink('robotcar'), seq_id)
+        stereo_dir = os.path.join(src_folder, 'stereo')
+        sources = [os.path.join(stereo_dir, 'left'),
+                   os.path.join(stereo_dir, 'right'),
+                   os.path.join(src_folder, 'gps', 'ins.csv'),
+                   os.path.join(sdk_dir, 'extrinsics', 'ins.txt')]
+        meta = metadata_cache.cached(
+            'robotcar_raw_%s' % seq_id, sources,
+            lambda: _parseRawSequence(src_folder))
+
+        left_ims = meta['left_ims'].tolist()
+        right_ims = meta['right_ims'].tolist()
+        assert len(left_ims) == len(right_ims)
+        assert len(left_ims) > 0
+
+        self._models = [camera_model.CameraModel(
+            cam_model_dir, os.path.join(stereo_dir, i))
+            for i in ['left', 'right']]
+        Ks = [croppedK(i) for i in self._models]
+        T_W_C = pose.fromMatrices(meta['T_W_C'])
+
+        base.RectifiedStereoSequence.__init__(
+            self, left_ims, right_ims, Ks[0], Ks[1], T_W_C, 0.24,
+            'rc', seq_id)
+        self.setDecoding(cache_bytes=cache_bytes)
+        self._readahead = readahead
+        self._num_threads = num_threads
+        self._pool = None
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_pending'] = set()
+        del state['_pending_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pending_lock = threading.Lock()
+
+    def close(self):
+        """ Stops the read-ahead threads. """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _decodeImage(self, i, right):
+        path = self.right_images[i] if right else self.images[i]
+        img = croppedGray(sdk('image').load_image(
+            path, self._models[1 if right else 0]))
+        if self._imread_flags == cv2.IMREAD_COLOR:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        return img
+
+    def _cachedImage(self, i, right):
+        img = base.RectifiedStereoSequence._cachedImage(self, i, right)
+        if self.image_cache is not None and self._readahead > 0:
+            self._readAhead(i, right)
+        return img
+
+    def _readAhead(self, i, right):
+        if self._pool is None:
+            import multiprocessing.pool
+            self._pool = multiprocessing.pool.ThreadPool(self._num_threads)
+        for j in range(i + 1, min(i + 1 + self._readahead, len(self))):
+            key = (right, j)
+            with self._pending_lock:
+                if key in self._pending or key in self.image_cache:
+                    continue
+                self._pending.add(key)
+            self._pool.apply_async(self._prefetch, (key,))
+
+    def _prefetch(self, key):
+        right, j = key
+        try:
+            self.image_cache.put(key, self._decodeImage(j, right))
+        finally:
+            with self._pending_lock:
+                self._pending.discard(key)
@@ -0,0 +1,62 @@
+# Copyright (C) 2019 Titus Cieslewski, RPG, University of Zurich, Switzerland
+#   You can contact the author at <titus at ifi dot uzh dot ch>
+# Copyright (C) 2019 Davide Scaramuzza, RPG, University of Zurich, Switzerland
+#
+# This file is part of imips_open_deps.
+#
+# imips_open_deps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# imips_open_deps is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with imips_open_deps. If not, see <http:#www.gnu.org/licenses/>.
+
+import numpy as np
+import scipy.spatial
+
+
+class SpatialIndex(object):
+    """ KD-tree over (N, 3) positions, typically
+    RectifiedMonoSequence.positions(), answering bulk neighbourhood queries
+    for pair mining. """
+    def __init__(self, positions):
+        self.positions = np.asarray(positions)
+        self.tree = scipy.spatial.cKDTree(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def radius(self, queries, max_distance):
+        """ For each (M, 3) query, the array of frames within max_distance.
+        """
+        return [np.array(sorted(i), dtype=int) for i in
+                self.tree.query_ball_point(queries, max_distance)]
+
+    def knn(self, queries, k):
+        """ Distances and frame indices, both (M, k). """
+        distances, indices = self.tree.query(queries, k=k)
+        return distances.reshape((-1, k)), indices.reshape((-1, k))
+
+    def pairs(self, max_distance, min_frame_gap=1):
+        """ (M, 2) frame pairs i < j at most max_distance apart and at least
+        min_frame_gap frames apart; the latter excludes consecutive frames,
+        so that large values only return revisits (loops). """
+        pairs = self.tree.query_pairs(max_distance, output_type='ndarray')
+        pairs = np.sort(pairs.reshape((-1, 2)), axis=1)
+        pairs = pairs[pairs[:, 1] - pairs[:, 0] >= min_frame_gap]
+        return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+    def crossPairs(self, other, max_distance):
+        """ (M, 2) pairs of frames (i of self, j of other SpatialIndex) at
+        most max_distance apart. Only meaningful if both sequences have their
+        poses expressed in the same world frame. """
+        distances = self.tree.sparse_distance_matrix(
+            other.tree, max_distance, output_type='ndarray')
+        pairs = np.stack((distances['i'], distances['j']), axis=1)
+        return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))].astype(int)
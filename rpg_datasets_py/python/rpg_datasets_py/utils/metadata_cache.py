@@ -0,0 +1,120 @@
+# Copyright (C) 2019 Titus Cieslewski, RPG, University of Zurich, Switzerland
+#   You can contact the author at <titus at ifi dot uzh dot ch>
+# Copyright (C) 2019 Davide Scaramuzza, RPG, University of Zurich, Switzerland
+#
+# This file is part of imips_open_deps.
+#
+# imips_open_deps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# imips_open_deps is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with imips_open_deps. If not, see <http:#www.gnu.org/licenses/>.
+
+# Caches parsed dataset metadata (poses, intrinsics, timestamps, file lists)
+# as binary .npz (or as memory-mappable .npy files, see cachedMemmap()),
+# keyed by the source files and directories it was parsed from. An entry is
+# stale as soon as the size or mtime of any source changes; adding or
+# removing files changes the mtime of their directory.
+
+import hashlib
+import numpy as np
+import os
+
+from rpg_datasets_py.utils.symlink import symlink
+import rpg_datasets_py.utils.path as utils_path
+
+# Set to False to always parse the sources.
+enabled = True
+_VERSION = 1
+
+
+def cacheDir():
+    return os.environ.get('RPG_DATASETS_CACHE', symlink('cache'))
+
+
+def _stamps(sources):
+    stats = [os.stat(i) for i in sources]
+    return np.array([[i.st_mtime, i.st_size] for i in stats])
+
+
+def _cacheFile(name, sources, extension='.npz'):
+    key = '\n'.join([str(_VERSION)] + [os.path.abspath(i) for i in sources])
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cacheDir(), '%s_%s%s' % (name, digest, extension))
+
+
+def _load(cache_file, stamps):
+    try:
+        data = np.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return None
+    if not np.array_equal(data['_stamps'], stamps):
+        return None
+    return dict((key, data[key]) for key in data.files if key != '_stamps')
+
+
+def cached(name, sources, compute):
+    """ compute() returns a dict of arrays (or of values that np.asarray()
+    turns into arrays without pickling, like lists of strings), which is
+    returned from the cache if none of the sources have changed. Values are
+    always returned as arrays. """
+    if not enabled:
+        return dict((key, np.asarray(value))
+                    for key, value in compute().items())
+    stamps = _stamps(sources)
+    cache_file = _cacheFile(name, sources)
+    result = _load(cache_file, stamps)
+    if result is not None:
+        return result
+
+    result = dict((key, np.asarray(value)) for key, value in compute().items())
+    try:
+        if not os.path.exists(cacheDir()):
+            os.makedirs(cacheDir())
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, _stamps=stamps, **result)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError):
+        # Read-only cache location: just don't cache.
+        pass
+    return result
+
+
+def cachedMemmap(name, sources, compute):
+    """ Like cached(), but every array is stored as its own .npy file and
+    returned as a read-only memory map. Meant for large arrays such as
+    sensor streams. Unlike cached(), this fails if the cache location is not
+    writable. """
+    stamps = _stamps(sources)
+    cache_folder = _cacheFile(name, sources, extension='')
+    stamps_file = os.path.join(cache_folder, '_stamps.npy')
+    if os.path.exists(stamps_file) and \
+            np.array_equal(np.load(stamps_file), stamps):
+        keys = [i[:-4] for i in os.listdir(cache_folder)
+                if i.endswith('.npy') and i != '_stamps.npy']
+        return dict((key, np.load(os.path.join(cache_folder, key + '.npy'),
+                                  mmap_mode='r')) for key in keys)
+
+    if not os.path.exists(cache_folder):
+        try:
+            os.makedirs(cache_folder)
+        except OSError:
+            # Created concurrently by another process.
+            if not os.path.isdir(cache_folder):
+                raise
+    # Files are replaced by rename, never overwritten, such that memory maps
+    # held by other processes (or older readers) stay valid.
+    for key, value in compute().items():
+        utils_path.saveNpyAtomic(
+            os.path.join(cache_folder, key + '.npy'), value)
+    # Written last: marks the entry as complete.
+    utils_path.saveNpyAtomic(stamps_file, stamps)
+    return cachedMemmap(name, sources, compute)
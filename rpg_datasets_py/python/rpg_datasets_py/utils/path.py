@@ -17,6 +17,7 @@
 # You should have received a copy of the GNU General Public License
 # along with imips_open_deps. If not, see <http:#www.gnu.org/licenses/>.
 
+import numpy as np
 import os
 
 
@@ -29,4 +30,14 @@ def imagesFromDir(root, extension='.jpg'):
 def imagesFromSubdirs(
         root, sub_names=['left', 'right'], extension='.jpg'):
     dirs = [os.path.join(root, i) for i in sub_names]
-    return [imagesFromDir(i, extension=extension) for i in dirs]
\ No newline at end of file
+    return [imagesFromDir(i, extension=extension) for i in dirs]
+
+
+def saveNpyAtomic(path, array):
+    """ np.save() to a temporary file that is then renamed to path, such that
+    readers never see a partial file and existing memory maps of path stay
+    valid. """
+    tmp_file = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        np.save(f, np.asarray(array))
+    os.rename(tmp_file, path)
@@ -0,0 +1,78 @@
+# Copyright (C) 2019 Titus Cieslewski, RPG, University of Zurich, Switzerland
+#   You can contact the author at <titus at ifi dot uzh dot ch>
+# Copyright (C) 2019 Davide Scaramuzza, RPG, University of Zurich, Switzerland
+#
+# This file is part of imips_open_deps.
+#
+# imips_open_deps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# imips_open_deps is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with imips_open_deps. If not, see <http:#www.gnu.org/licenses/>.
+
+# Measures how long importing each dataset module takes in a fresh
+# interpreter, and reports any heavy or optional dependency that the import
+# pulled in. Usage:
+#
+#   python benchmark_imports.py [--repeat N] [module ...]
+
+from __future__ import print_function
+import argparse
+import json
+import subprocess
+import sys
+
+modules = ['rpg_datasets_py.base', 'rpg_datasets_py.kitti',
+           'rpg_datasets_py.euroc', 'rpg_datasets_py.robotcar',
+           'rpg_datasets_py.tum_mono', 'rpg_datasets_py.hpatches',
+           'rpg_datasets_py.dtu']
+
+# Should only be imported by the preprocessing functions that need them.
+heavy = ['matplotlib', 'skimage', 'PIL', 'multiprocessing', 'IPython',
+         'hickle', 'camera_model', 'image', 'interpolate_poses', 'transform']
+
+_SNIPPET = """
+import json, sys, time
+start = time.time()
+import %s
+duration = time.time() - start
+print(json.dumps([duration, [m for m in %r if m in sys.modules]]))
+"""
+
+
+def measure(module, repeat):
+    durations = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', _SNIPPET % (module, heavy)])
+        duration, loaded = json.loads(output.decode().strip().split('\n')[-1])
+        durations.append(duration)
+    return sorted(durations)[len(durations) // 2], loaded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('modules', nargs='*', default=modules)
+    args = parser.parse_args()
+
+    print('%-28s %12s  %s' % ('module', 'median [ms]', 'heavy imports'))
+    for module in args.modules:
+        try:
+            duration, loaded = measure(module, args.repeat)
+        except subprocess.CalledProcessError:
+            print('%-28s %12s' % (module, 'failed'))
+            continue
+        print('%-28s %12.1f  %s' % (module, duration * 1000,
+                                    ', '.join(loaded) if loaded else '-'))
+
+
+if __name__ == '__main__':
+    main()